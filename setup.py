@@ -16,6 +16,9 @@ setup(
         "task-virtualthread",
         "Pillow", # 9.0.1
     ],
+    extras_require = {
+        "binary" : ["msgpack", "cbor2"] # binary websocket subprotocols for results
+    },
     include_package_data=True, # # conclusion: NEVER forget this : files get included but not installed
     # # WARNING: If you are using namespace packages, automatic package finding does not work, so use this:
     packages=[
@@ -0,0 +1,28 @@
+"""Unit tests for stream viewer admission control
+"""
+from valkka.streamer.multiprocess.bandwidth import Bandwidth
+
+
+def test_no_caps():
+    bandwidth = Bandwidth()
+    assert bandwidth.admit(1000) is None
+    assert bandwidth.admit(1000, thinned = True) is None
+
+
+def test_thin_over_max_viewers():
+    bandwidth = Bandwidth({"max_viewers": 2, "over_cap": "thin"})
+    assert bandwidth.admit(1) is None
+    assert bandwidth.admit(2) == "thin"
+    assert bandwidth.admit(3, thinned = True) is None
+
+
+def test_thinned_viewers_capped():
+    bandwidth = Bandwidth({"max_viewers": 2, "max_thinned": 3, "over_cap": "thin"})
+    assert bandwidth.admit(4) == "thin"
+    assert bandwidth.admit(5) == "reject"
+    assert bandwidth.admit(5, thinned = True) == "reject"
+
+
+def test_reject_over_max_viewers():
+    bandwidth = Bandwidth({"max_viewers": 2, "over_cap": "reject"})
+    assert bandwidth.admit(2) == "reject"
@@ -0,0 +1,36 @@
+"""Unit tests for delta encoding of detection results
+"""
+from valkka.streamer.multiprocess.codec import Message
+from valkka.streamer.multiprocess.delta import DeltaEncoder
+
+
+def result(seq, detections):
+    return Message({"detections": detections}, seq = seq)
+
+
+def test_full_then_diff():
+    encoder = DeltaEncoder()
+    full = encoder(result(1, [["car", 0.1, 0.2, 0.1, 0.2]]))
+    assert full.obj["delta"] == "full"
+    diff = encoder(result(2, [["car", 0.1, 0.2, 0.1, 0.2], ["person", 0.5, 0.6, 0.5, 0.6]]))
+    assert diff.obj["delta"] == "diff"
+    assert diff.obj["base"] == 1
+    assert list(diff.obj["add"].values()) == [["person", 0.5, 0.6, 0.5, 0.6]]
+
+
+def test_suppressed_messages_keep_base():
+    encoder = DeltaEncoder()
+    encoder(result(1, [["car", 0.1, 0.2, 0.1, 0.2]]))
+    assert encoder(result(2, [["car", 0.1, 0.2, 0.1, 0.2]])) is None # no changes
+    assert encoder(result(3, [["car", 0.1, 0.2, 0.1, 0.2]])) is None
+    diff = encoder(result(4, []))
+    assert diff.seq == 4
+    assert diff.obj["base"] == 1 # the gap 2..3 was suppressed, not lost
+    assert diff.obj["remove"] == ["1"]
+
+
+def test_shared_work_between_clients():
+    a, b = DeltaEncoder(), DeltaEncoder()
+    messages = [result(1, [["car", 0.1, 0.2, 0.1, 0.2]]), result(2, [])]
+    for message in messages:
+        assert a(message) is b(message)
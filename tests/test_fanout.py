@@ -0,0 +1,183 @@
+"""Unit tests for FragRing & Subscriber (pure python, no libValkka needed)
+"""
+from collections import namedtuple
+from valkka.streamer.multiprocess.fanout import FragRing
+
+Meta = namedtuple("Meta", ["name", "is_first"])
+
+
+def pushGOP(ring, n_frags, size = 10):
+    """Push a GOP of n_frags (moof, mdat) fragments, the first one being a keyframe
+    """
+    for i in range(n_frags):
+        ring.push(Meta("moof", i == 0), b"f" * 1, key = (i == 0))
+        ring.push(Meta("mdat", False), b"d" * size)
+
+
+def pullAll(subscriber):
+    items = []
+    while True:
+        item = subscriber.pull()
+        if item is None:
+            return items
+        items.append(item)
+
+
+def assertPairs(items):
+    """Every moof is followed by its mdat & every mdat follows a moof
+    """
+    names = [meta.name for meta, _ in items]
+    assert len(names) % 2 == 0, names
+    for i in range(0, len(names), 2):
+        assert names[i:i + 2] == ["moof", "mdat"], names
+
+
+def test_ring_push_get():
+    ring = FragRing(maxlen = 4)
+    for i in range(6):
+        ring.push(Meta("moof", False), bytes([i]))
+    assert ring.tail == 2 and ring.head == 6
+    assert ring.get(1) is None
+    assert ring.get(2)[1] == bytes([2])
+    assert ring.get(6) is None
+
+
+def test_ring_keys_and_bytes():
+    ring = FragRing(maxlen = 100)
+    pushGOP(ring, 2, size = 10)
+    pushGOP(ring, 2, size = 10)
+    assert list(ring.key_seqs) == [0, 4]
+    assert ring.latestKey() == 4
+    assert ring.isKey(4) and not ring.isKey(5)
+    assert ring.bytesFrom(4) == 22
+    assert ring.nbytes == 44
+
+
+def test_ring_maxbytes():
+    ring = FragRing(maxlen = 100, maxbytes = 30)
+    pushGOP(ring, 2, size = 10)
+    pushGOP(ring, 2, size = 10)
+    assert ring.nbytes <= 30
+    assert ring.key_seqs[0] >= ring.tail # dropped keyframes are forgotten
+
+
+def test_ring_grows_up_to_maxbytes():
+    # a long GOP of small fragments stays cached
+    ring = FragRing(maxlen = 4, maxbytes = 1000)
+    pushGOP(ring, 20, size = 10)
+    assert ring.maxlen >= 40
+    assert ring.tail == 0 and ring.latestKey() == 0
+    subscriber = ring.subscribe(from_key = True)
+    items = pullAll(subscriber)
+    assert len(items) == 40
+    assertPairs(items)
+    pushGOP(ring, 200, size = 10) # .. but not beyond maxbytes
+    assert ring.nbytes <= 1000
+
+
+def test_subscriber_reads_in_order():
+    ring = FragRing(maxlen = 100)
+    subscriber = ring.subscribe()
+    pushGOP(ring, 3)
+    items = pullAll(subscriber)
+    assert len(items) == 6
+    assertPairs(items)
+    assert subscriber.lag() == 0 and subscriber.drops == 0
+
+
+def test_subscriber_from_key():
+    ring = FragRing(maxlen = 100)
+    pushGOP(ring, 2)
+    pushGOP(ring, 2)
+    subscriber = ring.subscribe(from_key = True)
+    assert subscriber.cursor == 4
+    items = pullAll(subscriber)
+    assert items[0][0].is_first
+    assertPairs(items)
+
+
+def test_subscriber_overwritten_skips_to_key():
+    ring = FragRing(maxlen = 10)
+    subscriber = ring.subscribe()
+    pushGOP(ring, 3)
+    pushGOP(ring, 3) # overwrites the beginning of the first GOP
+    items = pullAll(subscriber)
+    assert subscriber.skips == 1
+    assert items[0][0].is_first
+    assertPairs(items)
+
+
+def test_subscriber_max_lag_keeps_fragments_whole():
+    # a new viewer starting from a cached GOP larger than max_lag
+    ring = FragRing(maxlen = 100)
+    pushGOP(ring, 5, size = 10)
+    subscriber = ring.subscribe(from_key = True, max_lag = 20)
+    items = pullAll(subscriber)
+    assert subscriber.skips > 0
+    assertPairs(items)
+    # new fragments are read whole after the skip
+    pushGOP(ring, 2, size = 10)
+    items = pullAll(subscriber)
+    assert items[0][0].is_first
+    assertPairs(items)
+
+
+def test_subscriber_max_lag_interleaved():
+    # lag builds up while reading: skips happen only at moofs
+    ring = FragRing(maxlen = 100)
+    subscriber = ring.subscribe(max_lag = 25)
+    items = []
+    for i in range(20):
+        pushGOP(ring, 3, size = 10)
+        items.append(subscriber.pull())
+        items.append(subscriber.pull())
+    items += pullAll(subscriber)
+    items = [item for item in items if item is not None]
+    assert subscriber.skips > 0
+    assertPairs(items)
+
+
+def test_ring_gop_bytes():
+    ring = FragRing(maxlen = 100)
+    pushGOP(ring, 2, size = 10)
+    assert ring.gop_bytes == 0 # first GOP not complete yet
+    pushGOP(ring, 3, size = 10)
+    assert ring.gop_bytes == 22
+
+
+def test_subscriber_default_max_lag_from_gop():
+    ring = FragRing(maxlen = 1000)
+    subscriber = ring.subscribe()
+    assert subscriber.maxLag() is None
+    pushGOP(ring, 2, size = 10)
+    pushGOP(ring, 2, size = 10)
+    assert subscriber.maxLag() == 2 * 22
+    for i in range(5): # lag behind by 5 GOPs
+        pushGOP(ring, 2, size = 10)
+    items = pullAll(subscriber)
+    assert subscriber.skips == 1
+    assert items[0][0].is_first
+    assertPairs(items)
+
+
+def test_subscriber_moof_waits_for_mdat():
+    ring = FragRing(maxlen = 100)
+    subscriber = ring.subscribe()
+    ring.push(Meta("moof", True), b"f", key = True)
+    assert subscriber.pull() is None
+    ring.push(Meta("mdat", False), b"d")
+    assertPairs(pullAll(subscriber))
+
+
+def test_subscriber_overrun_keeps_mdat():
+    # the ring is overrun right after a moof has been read
+    ring = FragRing(maxlen = 10)
+    subscriber = ring.subscribe()
+    pushGOP(ring, 1)
+    items = [subscriber.pull()]
+    pushGOP(ring, 3)
+    pushGOP(ring, 3)
+    items += pullAll(subscriber)
+    assert subscriber.skips == 1
+    assertPairs(items)
+    assert items[2][0].is_first # resynced at a keyframe
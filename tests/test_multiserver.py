@@ -0,0 +1,44 @@
+"""Unit tests for the shmem => asyncio side of MultiServerProcess (shmem clients replaced by fakes)
+"""
+import logging
+from collections import deque
+from valkka.streamer.multiprocess.multiserver import MultiServerProcess
+from valkka.streamer.multiprocess.fanout import MessageChannel
+
+
+class FakeIntercomClient:
+    """Queued objects instead of a shmem ringbuffer
+    """
+    def __init__(self, objs):
+        self.objs = deque(objs)
+
+    def pullObject(self):
+        if len(self.objs) < 1:
+            return None
+        return self.objs.popleft()
+
+
+def multiServer(fd, client, channel, n_ringbuffer = 10):
+    """A MultiServerProcess with just the state needed by rgbCallback (no multiprocessing)
+    """
+    server = MultiServerProcess.__new__(MultiServerProcess)
+    server.logger = logging.getLogger("test_multiserver")
+    server.drain = True
+    server.wakeup_count = 0
+    server.pull_count = 0
+    server.skip_count = 0
+    server.intercom_client_by_fd = {fd: client}
+    server.intercom_channel_by_fd = {fd: channel}
+    server.n_ringbuffer_by_fd = {fd: n_ringbuffer}
+    return server
+
+
+def test_rgb_callback_drains_with_subscriber():
+    client = FakeIntercomClient([{"n": i} for i in range(5)])
+    channel = MessageChannel()
+    subscriber = channel.subscribe()
+    server = multiServer(3, client, channel)
+    server.rgbCallback(3) # one eventfd trigger
+    assert len(client.objs) == 0
+    assert server.pull_count == 5
+    assert [message.obj["n"] for message in subscriber.queue] == list(range(5))
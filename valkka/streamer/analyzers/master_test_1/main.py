@@ -80,7 +80,8 @@ class MasterProcess(MasterProcess_):
                 bbox[3].item()  # bottom
             ])
         obj = {
-            "detections" : lis
+            "detections" : lis,
+            "mstimestamp" : meta.mstimestamp # of the analyzed frame
         }
         # sends a message to the correct client:
         server = self.data_server_by_client_fd[fd]
@@ -51,12 +51,14 @@ class AnalyzerProcess(ClientProcess):
                 self.logger.debug("handleFrame__ : yikes! got some creepy (new) movement")
                 # send a message to the websocket server
                 self.data_server.pushObject({
-                    "status" : "something moving!"
+                    "status" : "something moving!",
+                    "mstimestamp" : meta.mstimestamp # of the analyzed frame
                 })
             else:
                 self.logger.debug("handleFrame__ : all (again) still")
                 self.data_server.pushObject({
-                    "status" : "all (again) still.."
+                    "status" : "all (again) still..",
+                    "mstimestamp" : meta.mstimestamp
                 })
         self.prev_status = movement
 
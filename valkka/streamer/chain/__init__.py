@@ -1,2 +1,3 @@
 from valkka.streamer.chain.main import MainBranch
 from valkka.streamer.chain.rgb import RGB24Branch
+from valkka.streamer.chain.tap import RGB24Tap, TapRegistry
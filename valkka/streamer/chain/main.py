@@ -13,16 +13,20 @@ class MainBranch:
             main_fork
                 A: (AVThread:avthread)
                         decoder_fork (on-demand fork)
+                        .. decoding is on only while something is connected to decoder_fork
+                           (see connectYUV & disconnectYUV)
                 B: {FragMP4MuxFrameFilter:fragmp4muxer}
                         {GateFrameFilter:fragmp4_gate}
                             {FragMP4ShmemFrameFilter:fragmp4shmem}
     
     """
-    def __init__(self, address: str = None, slot: int = None, livethread = None, camname = None, vaapi = False):
+    def __init__(self, address: str = None, slot: int = None, livethread = None, camname = None, vaapi = False,
+            decoder_core = None):
         """
         :param address: rtsp address (str)
         :param slot: slot number (int)
         :param livethread: a running LiveThread
+        :param decoder_core: pin the decoder thread to this cpu core (int) or None
         """
         assert(address is not None)
         assert(slot is not None)
@@ -32,6 +36,8 @@ class MainBranch:
         self.logger = logging.getLogger("filterchain") # as per ini file
 
         self.closed = False
+        self.started = False
+        self.yuv_consumers = set() # names of the filters connected to decode_fork
         self.address = address
         self.slot = slot
         self.camname = camname
@@ -68,6 +74,8 @@ class MainBranch:
         else:
             self.avthread = core.AVThread("avthread_"+str(self.slot), self.decode_fork)
         self.avthread_in = self.avthread.getFrameFilter()
+        if decoder_core is not None:
+            self.avthread.setAffinity(decoder_core) # before starting the thread
 
         # main branch
         self.main_fork = core.ForkFrameFilterN("main_fork_"+str(self.slot))
@@ -91,14 +99,29 @@ class MainBranch:
         self.livethread.registerStreamCall(self.ctx)
         self.livethread.playStreamCall(self.ctx)
         self.avthread.startCall()
-        self.avthread.decodingOnCall()
+        self.started = True
+        if len(self.yuv_consumers) > 0:
+            self.avthread.decodingOnCall()
         
     def connectYUV(self, name = None, target_filter = None):
+        """Connect a consumer of decoded frames.  Decoding is turned on for the first one
+        """
         assert name is not None
         assert target_filter is not None
         self.decode_fork.connect(name, target_filter)
+        first = (len(self.yuv_consumers) == 0)
+        self.yuv_consumers.add(name)
+        if first and self.started:
+            self.logger.debug("filterchain: %s: decoding on", self.slot)
+            self.avthread.decodingOnCall()
 
     def disconnectYUV(self, name):
+        """Disconnect a consumer of decoded frames.  Decoding is turned off after the last one
+        """
+        self.yuv_consumers.discard(name)
+        if len(self.yuv_consumers) == 0 and self.started:
+            self.logger.debug("filterchain: %s: decoding off", self.slot)
+            self.avthread.decodingOffCall()
         self.decode_fork.disconnect(name)
     
     def getFMP4ShmemPars(self):
@@ -120,6 +143,12 @@ class MainBranch:
         self.logger.debug("filterchain: %s: fmp4 activated", self.slot)
         
 
+    def sendFMP4Meta(self):
+        """Make the muxer resend ftyp & moov
+        """
+        self.fragmp4_muxer.sendMeta()
+
+
     def deactivateFMP4ShmemChannel(self):
         self.logger.debug("filterchain: %s: fmp4 deactivate", self.slot)
         self.fragmp4_gate.unSet()
@@ -0,0 +1,136 @@
+import logging
+from valkka import core
+from valkka.streamer.singleton import event_fd_group_1
+
+
+class RGB24Tap:
+    """A shared memory server for RGB24 frames that have already been scaled:
+
+    ::
+
+        {RGBSharedMemFrameFilter: shmem_filter}
+
+    A shmem ringbuffer can have only one reader, so each reader needs a tap of its own.
+    Don't instantiate directly, but use TapRegistry.acquire
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.name = str(id(self)) + "_rgb" # This identifies posix shared memory - must be unique
+        self.n = 10 # Size of the shmem ringbuffer
+        _, self.event = event_fd_group_1.reserve()
+        self.rgbshmem_filter = core.RGBShmemFrameFilter(
+            self.name,
+            self.n,
+            self.width,
+            self.height)
+        self.rgbshmem_filter.useFd(self.event)
+        self.key = None # set by TapRegistry
+
+    def __call__(self):
+        """Return terminal frame filter
+        """
+        return self.rgbshmem_filter
+
+    def getPars(self):
+        return {
+            "name" : self.name,
+            "n_ringbuffer" : self.n,
+            "height" : self.height,
+            "width" : self.width,
+            "ipc_index" : event_fd_group_1.asIndex(self.event),
+        }
+
+    def close(self):
+        event_fd_group_1.release(self.event)
+
+
+class ScaledBranch:
+    """Scales decoded frames once for all taps of the same size & interval:
+
+    ::
+
+        {IntervalFrameFilter: interval_filter}
+            {SwScaleFrameFilter: sws_filter}
+                {ForkFrameFilterN: fork}
+                    {RGBSharedMemFrameFilter} (RGB24Tap)
+                    {RGBSharedMemFrameFilter} (RGB24Tap)
+                    ..
+    """
+    def __init__(self, name, image_interval, width, height):
+        self.name = name
+        self.fork = core.ForkFrameFilterN("fork_" + name)
+        self.sws_filter = core.SwScaleFrameFilter("sws_" + name, width, height, self.fork)
+        self.interval_filter = core.TimeIntervalFrameFilter("interval_" + name,
+            image_interval,
+            self.sws_filter)
+        self.taps = set()
+
+    def __call__(self):
+        """Return the first frame filter
+        """
+        return self.interval_filter
+
+
+class TapRegistry:
+    """Hands out RGB24Taps of decoded frames of cameras (i.e. MainBranches)
+
+    Taps of the same camera, size & interval share a single ScaledBranch, so each frame
+    is scaled once, no matter how many readers (analyzers, snapshots, mosaics) there are.
+    The ScaledBranch is reference counted: it's disconnected from the camera together with its last tap
+
+    ::
+
+        registry = TapRegistry()
+        tap = registry.acquire(main_branch, 416, 416, 100)
+        tap.getPars() # --> shmem parameters for the reader
+        ..
+        registry.release(tap)
+    """
+    def __init__(self):
+        self.logger = logging.getLogger("filterchain") # as per ini file
+        self.branch_by_key = {}
+        self.main_branch_by_key = {}
+
+    def acquire(self, main_branch, width, height, image_interval):
+        key = (main_branch.camname, width, height, image_interval)
+        try:
+            branch = self.branch_by_key[key]
+        except KeyError:
+            name = "%s_%sx%s_%s" % key
+            branch = ScaledBranch(name, image_interval, width, height)
+            main_branch.connectYUV(name = name, target_filter = branch())
+            self.branch_by_key[key] = branch
+            self.main_branch_by_key[key] = main_branch
+            self.logger.debug("TapRegistry: new scaler %s", name)
+        tap = RGB24Tap(width, height)
+        tap.key = key
+        branch.fork.connect(tap.name, tap())
+        branch.taps.add(tap)
+        return tap
+
+    def release(self, tap):
+        branch = self.branch_by_key[tap.key]
+        branch.fork.disconnect(tap.name)
+        branch.taps.discard(tap)
+        tap.close()
+        if len(branch.taps) == 0:
+            self.main_branch_by_key.pop(tap.key).disconnectYUV(branch.name)
+            self.branch_by_key.pop(tap.key)
+            self.logger.debug("TapRegistry: scaler %s removed", branch.name)
+
+    def close(self):
+        """Release the shmem eventfds of all taps (after the MainBranches have been closed)
+        """
+        for branch in self.branch_by_key.values():
+            for tap in branch.taps:
+                tap.close()
+            branch.taps.clear()
+        self.branch_by_key.clear()
+        self.main_branch_by_key.clear()
+
+    def numScalers(self):
+        return len(self.branch_by_key)
+
+    def numTaps(self):
+        return sum(len(branch.taps) for branch in self.branch_by_key.values())
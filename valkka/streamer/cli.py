@@ -1,4 +1,4 @@
-import logging
+import logging, signal
 from valkka.streamer.tools import YamlCLI, getDataFile
 from valkka.streamer.main import Manager
 from valkka.streamer.multiprocess import MultiServerProcess
@@ -13,6 +13,15 @@ def main():
     # Manager.formatLogger(logging.DEBUG) # of course in a real app, in some other way
     # MultiServerProcess.formatLogger(logging.DEBUG)
     manager = Manager(args=args, cfg=cfg)
+
+    def reload(signum, frame):
+        """kill -HUP: re-read the yaml file & apply the camera changes without a restart
+
+        Only flags the manager: the file is read in its main loop
+        """
+        manager.requestReconcile(args.yaml)
+
+    signal.signal(signal.SIGHUP, reload)
     manager()
 
 
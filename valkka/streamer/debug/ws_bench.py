@@ -0,0 +1,89 @@
+"""Benchmark websocket server CPU usage per Mbit/s, with & without permessage-deflate
+
+Pushes incompressible payload (like H.264 fmp4 fragments) or json detection results
+through the same server protocol MultiServerProcess uses & reports the server's
+cpu time per sent Mbit:
+
+::
+
+    python3 -m valkka.streamer.debug.ws_bench --payload video
+    python3 -m valkka.streamer.debug.ws_bench --payload json
+
+"""
+import asyncio, functools, json, os, random, resource, time, argparse
+from multiprocessing import Process
+import websockets
+from valkka.streamer.multiprocess.wsprotocol import StreamerServerProtocol, extensionsByEndpoint
+
+
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def makePayloads(kind, n = 100):
+    if kind == "video":
+        # compressed video is practically random bytes
+        return [os.urandom(random.randint(5000, 60000)) for i in range(n)]
+    return [json.dumps({"detections" : [
+        ["car", random.random(), random.random(), random.random(), random.random()]
+        for j in range(20)]}) for i in range(n)]
+
+
+def client(port, endpoint):
+    async def receive():
+        async with websockets.connect(f"ws://localhost:{port}/ws/{endpoint}/bench", max_size = None) as websocket:
+            try:
+                while True:
+                    await websocket.recv()
+            except websockets.ConnectionClosed:
+                pass
+    asyncio.run(receive())
+
+
+async def run(port, endpoint, deflate, payloads, seconds):
+    sent = 0
+    async def handler(websocket):
+        nonlocal sent
+        t0 = time.time()
+        i = 0
+        while time.time() - t0 < seconds:
+            payload = payloads[i % len(payloads)]
+            await websocket.send(payload)
+            sent += len(payload)
+            i += 1
+
+    create_protocol = functools.partial(StreamerServerProtocol,
+        extensions_by_endpoint = extensionsByEndpoint({endpoint : deflate}))
+    async with websockets.serve(handler, "localhost", port,
+            create_protocol = create_protocol, compression = None, max_size = None):
+        p = Process(target = client, args = (port, endpoint))
+        p.start()
+        c0 = cpuTime()
+        t0 = time.time()
+        await asyncio.get_event_loop().run_in_executor(None, p.join)
+        cpu = cpuTime() - c0
+        dt = time.time() - t0
+    mbit = sent * 8 / 1e6
+    return mbit / dt, cpu * 1000 / mbit
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payload", action="store", type=str, default="video", help="video or json")
+    parser.add_argument("--seconds", action="store", type=float, default=5)
+    parser.add_argument("--port", action="store", type=int, default=3010)
+    args = parser.parse_args()
+
+    endpoint = "stream" if args.payload == "video" else "message"
+    payloads = makePayloads(args.payload)
+    for label, deflate in [
+            ("no compression", None),
+            ("permessage-deflate", {"server_max_window_bits" : 12, "client_max_window_bits" : 12, "mem_level" : 5})
+        ]:
+        mbps, cpu_per_mbit = asyncio.run(run(args.port, endpoint, deflate, payloads, args.seconds))
+        print(f"{args.payload:5s} {label:20s}: {mbps:8.1f} Mbit/s, server cpu {cpu_per_mbit:6.3f} ms per Mbit")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,10 @@
-import importlib, traceback
+import importlib, traceback, time, yaml
 from valkka import core
 from valkka.multiprocess import MainContext, MessageProcess, MessageObject, safe_select
 from valkka.streamer.tools import getDataPath
-from valkka.streamer.chain import MainBranch, RGB24Branch
+from valkka.streamer.shard import HashRing
+from valkka.streamer.placement import Placement, sortByWeight
+from valkka.streamer.chain import MainBranch, TapRegistry
 from valkka.streamer.multiprocess import MasterProcess, ClientProcess, \
     MultiServerProcess, NGWrapper
 
@@ -15,14 +17,49 @@ class Manager(MainContext):
         """
         # self.n_workers = n_workers
         self.timeout = 2.0
-        self.livethread = core.LiveThread("livethread")
+        self.fmp4_viewers_by_name = {} # camera name => number of websocket viewers
+        self.fmp4_deadline_by_name = {} # camera name => deactivate fmp4 at this time (if still no viewers)
         self.closed = False
+        self.pending_yaml = None # yaml file to be re-read & reconciled by the main loop
+        self.taps = TapRegistry() # rgb24 taps of all cameras, sharing scalers
         self.args = args
+        self.checkConfig__(cfg)
         self.cfg = cfg
+        self.threadsFromConfig()
         self.filterChainFromConfig()
         super().__init__() # TODO: DOCS: this should always be the last line of __init__
 
 
+    def threadsFromConfig(self):
+        """Receiver (LiveThread) & decoder (AVThread) threads for large camera counts
+
+        ::
+
+            threads:
+                livethreads: 2                  # number of rtsp receiver threads
+                livethread_cores: [0, 1]        # pin the receiver threads to these cpu cores
+                decoder_cores: [2, 3, 4, 5]     # pin the decoder threads to these cpu cores
+
+        Cameras are balanced over the receiver threads & the decoder cores by their
+        (estimated) bitrate in Mbit/s, i.e. the "bitrate" of each stream (default 4).
+
+        There is still one decoder thread per camera (an AVThread decodes a single stream),
+        but with decoder_cores, all decoding is bound to a fixed set of cores
+        """
+        pars = self.cfg.get("threads", {})
+        n_livethreads = pars.get("livethreads", 1)
+        livethread_cores = pars.get("livethread_cores")
+        self.livethreads = []
+        for i in range(n_livethreads):
+            livethread = core.LiveThread(f"livethread_{i}")
+            if livethread_cores:
+                livethread.setAffinity(livethread_cores[i % len(livethread_cores)])
+            self.livethreads.append(livethread)
+        self.livethread_placement = Placement(n_livethreads)
+        self.decoder_cores = pars.get("decoder_cores")
+        self.decoder_placement = Placement(len(self.decoder_cores)) if self.decoder_cores else None
+
+
     def filterChainFromConfig(self):
         """Create filterchains from the dictionary, created from the yaml file
 
@@ -37,87 +74,411 @@ class Manager(MainContext):
             ws_stream: true
 
         """
-        cc = 1
+        self.next_slot = 1 # slot numbers are never reused
         self.main_branches_by_name = {}
-        for stream in self.cfg["streams"]:
+        # heaviest streams placed first for a better balance
+        for stream in sortByWeight(self.cfg["streams"], lambda stream: stream.get("bitrate", 4)):
             if not stream["use"]:
                 continue
-            main_branch = MainBranch(address = stream["address"],
-                slot = cc, livethread = self.livethread, camname = stream["name"],
-                vaapi = self.cfg["vaapi"]
-            )
-            cc += 1
-            self.main_branches_by_name[stream["name"]] = main_branch
+            self.addMainBranch__(stream)
+
+
+    def addMainBranch__(self, stream):
+        name = stream["name"]
+        bitrate = stream.get("bitrate", 4)
+        i = self.livethread_placement.place(name, bitrate)
+        livethread = self.livethreads[i]
+        decoder_core = None
+        if self.decoder_placement is not None:
+            decoder_core = self.decoder_cores[self.decoder_placement.place(name, bitrate)]
+        main_branch = MainBranch(address = stream["address"],
+            slot = self.next_slot, livethread = livethread, camname = name,
+            vaapi = self.cfg["vaapi"], decoder_core = decoder_core
+        )
+        self.next_slot += 1
+        self.main_branches_by_name[name] = main_branch
+        # NOTE: no logging here: at startup, this runs before MainContext.__init__ has created the logger
+        return main_branch
 
 
     def detectorsFromConfig(self):
         """Associate analyzer processes to cameras
         """
         self.logger.debug("associating analyzer processes to cameras")
+        self.detector_by_name = {} # camera name => dict of process, rgb24 branch, etc.
+        for stream in self.cfg["streams"]:
+            self.attachDetector__(stream)
+
+
+    def attachDetector__(self, stream):
+        if "detector" not in stream: # no detector for this camera..
+            return
+        # get the main branch
+        name = stream["name"]
+        try:
+            main_branch = self.main_branches_by_name[name]
+        except KeyError:
+            return # that camera is not in use..
+        # get detector name and associated running analyzer process
+        detector_name=stream["detector"]
+        try:
+            p = self.avail_process_cache[detector_name].pop(0)
+        except KeyError:
+            self.logger.critical("no such process type %s ?", detector_name)
+            traceback.print_exc()
+            return
+        except IndexError:
+            self.logger.critical("no more processes of type %s avail ?", detector_name)
+            traceback.print_exc()
+            return
+        rgb24_tap = self.taps.acquire(main_branch,
+            stream["interpolate"][0], stream["interpolate"][1], stream["ms_pass"])
+        pars = rgb24_tap.getPars()
+        p.activateRGB24Client(
+            **pars
+        )
+        # uuid could identify for example a bbox, etc. now it is just the camera name
+        p.setUUID(name)
+        if "detector_pars" in stream:
+            p.setPars(**stream["detector_pars"])
+        # lets save the filterchain branch to the
+        # associated multiprocess as a member :)
+        p.my_branch=rgb24_tap
+        self.logger.debug("process %s of type %s associated to camera %s", p, detector_name, name)
+
+        master = None
+        if hasattr(p, "master_process_name"):
+            self.logger.debug("process %s of type %s requires a master process %s", 
+                p, detector_name, p.master_process_name)
+            try:
+                master = self.avail_master_process_cache[p.master_process_name].pop(0)
+            except KeyError:
+                self.logger.critical("no such master process type %s", p.master_process_name)
+            except IndexError:
+                self.logger.critical("no more processes of type %s avail", p.master_process_name)
+            else:
+                master.registerClientProcess(p)
+                if not master.full():
+                    # this master process can still support more clients, so keep it in the list
+                    self.avail_master_process_cache[p.master_process_name].insert(0, master)
+
+        # tell websocket server (the shard owning this uuid) to listen to results
+        # from this analyzer process
+        # MultiServer.registerRGBProcess calls
+        # RGB24Processes' getDataShmemPars()
+        self.getMultiServer(p.getUUID()).registerRGBProcess(p, **stream.get("delivery", {}))
+        self.detector_by_name[name] = {
+            "type" : detector_name,
+            "process" : p,
+            "master" : master,
+            "tap" : rgb24_tap
+        }
+
+
+    def detachDetector__(self, name):
+        """Release the analyzer process of camera name back into the cache of available processes
+        """
+        try:
+            detector = self.detector_by_name.pop(name)
+        except KeyError:
+            return
+        p, master, rgb24_tap = detector["process"], detector["master"], detector["tap"]
+        self.getMultiServer(p.getUUID()).deregisterRGBProcess(p)
+        p.deactivateRGB24Client(rgb24_tap.getPars()["ipc_index"])
+        if master is not None:
+            master.deregisterClientProcess(p)
+            p.dropDataServer()
+            cache = self.avail_master_process_cache[p.master_process_name]
+            if master not in cache:
+                cache.insert(0, master)
+        self.taps.release(rgb24_tap)
+        p.my_branch = None
+        self.avail_process_cache[detector["type"]].append(p)
+        self.logger.debug("process %s released from camera %s", p, name)
+
+
+    def tapsFromConfig(self):
+        """Decoded frames for HTTP snapshots at /snapshot/camname.jpg & JPEG streams at /ws/jpeg/camname
+
+        ::
+
+            ws_server:
+                jpeg:
+                    use: true
+                    width: 640
+                    height: 360
+                    fps: 1
+                    quality: 80
+
+        Can be overridden per stream with a "jpeg" section
+        """
+        self.tap_by_name = {}
         for stream in self.cfg["streams"]:
-            if "detector" in stream: # this stream has an associated detector
-                # get the main branch
-                name = stream["name"]
-                try:
-                    main_branch = self.main_branches_by_name[name]
-                except KeyError:
-                    continue # that camera is not in use..
-                # get detector name and associated running analyzer process
-                try:
-                    detector_name=stream["detector"]
-                except KeyError:
-                    continue # no detector for this camera..
-                try:
-                    p = self.avail_process_cache[detector_name].pop(0)
-                except KeyError:
-                    self.logger.critical("no such process type %s ?", detector_name)
-                    traceback.print_exc()
+            self.attachTap__(stream)
+
+
+    def attachTap__(self, stream):
+        name = stream["name"]
+        try:
+            main_branch = self.main_branches_by_name[name]
+        except KeyError:
+            return # that camera is not in use..
+        pars = dict(self.cfg["ws_server"].get("jpeg", {}))
+        pars.update(stream.get("jpeg", {}))
+        if not pars.get("use", False):
+            return
+        rgb24_tap = self.taps.acquire(main_branch,
+            pars.get("width", 640), pars.get("height", 360), int(1000 / pars.get("fps", 1)))
+        self.getMultiServer(name).registerRGBTap(name, rgb24_tap.getPars(),
+            quality = pars.get("quality", 80))
+        self.tap_by_name[name] = rgb24_tap
+        self.logger.debug("snapshots enabled for camera %s", name)
+
+
+    def detachTap__(self, name):
+        try:
+            rgb24_tap = self.tap_by_name.pop(name)
+        except KeyError:
+            return
+        self.getMultiServer(name).deregisterRGBTap(rgb24_tap.getPars())
+        self.taps.release(rgb24_tap)
+
+
+    def mosaicsFromConfig(self):
+        """Server-side mosaics of several cameras, served like cameras at /snapshot/name.jpg
+        & /ws/jpeg/name
+
+        ::
+
+            mosaics:
+              - name: wall1
+                use: true
+                columns: 4
+                tile: [320, 180] # w, h
+                fps: 2
+                quality: 70
+                cameras: [mummocamera1, mummocamera2, null, mummocamera3] # row by row, null = empty tile
+
+        Each mosaic lives in the websocket server shard owning the mosaic name
+        """
+        self.mosaic_by_name = {}
+        self.mosaic_tiles_by_name = {} # camera name => list of (mosaic name, tile index, rgb24 tap)
+        for mosaic in self.cfg.get("mosaics", []):
+            if not mosaic.get("use", True):
+                continue
+            name = mosaic["name"]
+            if name in self.main_branches_by_name:
+                self.logger.critical("mosaic name %s is a camera name", name)
+                continue
+            width, height = mosaic["tile"]
+            self.getMultiServer(name).registerMosaic(name, len(mosaic["cameras"]), mosaic["columns"],
+                width, height, fps = mosaic.get("fps", 1), quality = mosaic.get("quality", 80))
+            self.mosaic_by_name[name] = mosaic
+            for tile, camname in enumerate(mosaic["cameras"]):
+                if camname is None:
                     continue
-                except IndexError:
-                    self.logger.critical("no more processes of type %s avail ?", detector_name)
-                    traceback.print_exc()
+                if camname not in self.main_branches_by_name:
+                    self.logger.warning("mosaic %s: camera %s not in use", name, camname)
                     continue
-                rgb24_branch = RGB24Branch(image_interval = stream["ms_pass"],
-                    width = stream["interpolate"][0],
-                    height = stream["interpolate"][1]
-                )
-                main_branch.connectYUV(name = detector_name,
-                    target_filter = rgb24_branch() 
-                )
-                pars = rgb24_branch.getPars()
-                p.activateRGB24Client(
-                    **pars
-                )
-                # uuid could identify for example a bbox, etc. now it is just the camera name
-                p.setUUID(name)
-                if "detector_pars" in stream:
-                    p.setPars(**stream["detector_pars"])
-                # lets save the filterchain branch to the
-                # associated multiprocess as a member :)
-                p.my_branch=rgb24_branch
-                self.logger.debug("process %s of type %s associated to camera %s", p, detector_name, name)
-
-                if hasattr(p, "master_process_name"):
-                    self.logger.debug("process %s of type %s requires a master process %s", 
-                        p, detector_name, p.master_process_name)
-                    try:
-                        master = self.avail_master_process_cache[p.master_process_name].pop(0)
-                    except KeyError:
-                        self.logger.critical("no such master process type %s", p.master_process_name)
-                        continue
-                    except IndexError:
-                        self.logger.critical("no more processes of type %s avail", p.master_process_name)
-                        continue
-                    master.registerClientProcess(p)
-                    if not master.full():
-                        # this master process can still support more clients, so keep it in the list
-                        self.avail_master_process_cache[p.master_process_name].insert(0, master)
+                self.attachMosaicTile__(mosaic, tile, camname)
+            self.logger.debug("mosaic %s created", name)
+
 
-                # tell websocket server to listen to results
-                # from this analyzer process
-                # MultiServer.registerRGBProcess calls
-                # RGB24Processes' getDataShmemPars()
-                self.multiserver.registerRGBProcess(p)
+    def attachMosaicTile__(self, mosaic, tile, camname):
+        name = mosaic["name"]
+        width, height = mosaic["tile"]
+        rgb24_tap = self.taps.acquire(self.main_branches_by_name[camname],
+            width, height, int(1000 / mosaic.get("fps", 1)))
+        self.getMultiServer(name).registerRGBTap(camname, rgb24_tap.getPars(), mosaic = name, tile = tile)
+        self.mosaic_tiles_by_name.setdefault(camname, []).append((name, tile, rgb24_tap))
+
+
+    def detachMosaicTiles__(self, camname):
+        """The mosaic tiles of camera camname keep their last frame
+        """
+        for name, tile, rgb24_tap in self.mosaic_tiles_by_name.pop(camname, []):
+            self.getMultiServer(name).deregisterRGBTap(rgb24_tap.getPars())
+            self.taps.release(rgb24_tap)
+
+
+    def attachMosaicTiles__(self, camname):
+        for name, mosaic in self.mosaic_by_name.items():
+            for tile, camname_ in enumerate(mosaic["cameras"]):
+                if camname_ == camname:
+                    self.attachMosaicTile__(mosaic, tile, camname)
+
+
+    def reconcile(self, cfg):
+        """Apply a new configuration at runtime, touching only the cameras that have changed
+
+        Compares the streams section of cfg to the running state:
+
+        - new cameras get a MainBranch that is started & registered to the websocket server
+        - removed cameras (or cameras with a new address) are deregistered & closed
+        - for the other cameras, only the analyzer association and/or the snapshot tap are
+          re-created, if their parameters have changed: the rtsp connection & the viewers are not disturbed
+
+        Analyzer processes are taken from & returned to the caches of running processes.  The
+        other sections of the yaml (processes, ws_server, nginx, mosaics, ..) are not reconciled: changing them
+        requires a restart.  Note that nginx routes are not updated either: with n_workers > 1 & nginx,
+        a new camera owned by a shard other than the first one is not reachable through nginx
+
+        The streams section is validated before any change is applied (see checkStreams__) &
+        self.cfg is updated only after all changes have been applied
+
+        Call from the thread running the main loop (see requestReconcile)
+        """
+        self.checkStreams__(cfg)
+        old_streams = {stream["name"] : stream for stream in self.cfg["streams"]
+            if stream["use"] and stream["name"] in self.main_branches_by_name} # i.e. running
+        new_streams = {stream["name"] : stream for stream in cfg["streams"] if stream["use"]}
+        detector_keys = ["detector", "detector_pars", "delivery", "ms_pass", "interpolate"]
+        for name, old in old_streams.items():
+            new = new_streams.get(name)
+            if new is None or new["address"] != old["address"]:
+                t = time.monotonic()
+                self.removeStream__(name)
+                self.logger.info("reconcile: removed camera %s in %.1f ms", name, 1000 * (time.monotonic() - t))
+                continue
+            if any(new.get(key) != old.get(key) for key in detector_keys):
+                self.detachDetector__(name)
+                self.attachDetector__(new)
+                self.logger.info("reconcile: camera %s: analyzer re-associated", name)
+            if new.get("jpeg") != old.get("jpeg"):
+                self.detachTap__(name)
+                self.attachTap__(new)
+                self.logger.info("reconcile: camera %s: snapshot tap re-created", name)
+        for name, new in new_streams.items():
+            if name not in self.main_branches_by_name:
+                t = time.monotonic()
+                self.addStream__(new)
+                self.logger.info("reconcile: added camera %s in %.1f ms", name, 1000 * (time.monotonic() - t))
+        self.cfg["streams"] = cfg["streams"]
+
+
+    def checkStreams__(self, cfg):
+        """Raises ValueError if the streams section of cfg can't be reconciled
+        """
+        if not isinstance(cfg, dict) or not isinstance(cfg.get("streams"), list):
+            raise ValueError("no streams section")
+        names = set()
+        for stream in cfg["streams"]:
+            if not isinstance(stream, dict) or "name" not in stream:
+                raise ValueError("stream without a name: %s" % (stream,))
+            name = stream["name"]
+            if name in names:
+                raise ValueError("stream %s defined twice" % name)
+            names.add(name)
+            if "use" not in stream:
+                raise ValueError("stream %s: use missing" % name)
+            if stream["use"] and "address" not in stream:
+                raise ValueError("stream %s: address missing" % name)
+            self.checkFps__(stream.get("jpeg", {}), "stream %s: jpeg" % name)
+
+
+    def checkConfig__(self, cfg):
+        """Raises ValueError if cfg can't be used.  See also checkStreams__
+        """
+        self.checkStreams__(cfg)
+        ws_server = cfg.get("ws_server", {})
+        self.checkFps__(ws_server.get("jpeg", {}), "ws_server: jpeg")
+        self.checkFps__(ws_server.get("bandwidth") or {}, "ws_server: bandwidth", key = "thin_fps")
+        for mosaic in cfg.get("mosaics") or []:
+            self.checkFps__(mosaic, "mosaic %s" % mosaic.get("name"))
+
+
+    def checkFps__(self, pars, where, key = "fps"):
+        fps = pars.get(key, 1)
+        if not isinstance(fps, (int, float)) or fps <= 0:
+            raise ValueError("%s: %s must be > 0" % (where, key))
+
+
+    def requestReconcile(self, yaml_file):
+        """Thread & signal-safe: the yaml file is read & reconciled by the main loop at its next wakeup
+        """
+        self.pending_yaml = yaml_file
+
+
+    def reloadConfig__(self, yaml_file):
+        """Read a yaml file & reconcile it.  A bad configuration is logged & ignored
+        """
+        try:
+            with open(yaml_file, "r") as f:
+                cfg = yaml.load(f, Loader=yaml.FullLoader)
+            self.checkStreams__(cfg)
+        except (OSError, yaml.YAMLError, ValueError) as e:
+            self.logger.critical("reload: ignoring %s: %s", yaml_file, e)
+            return
+        try:
+            self.reconcile(cfg)
+        except Exception as e:
+            # cameras changed up to this point stay changed
+            self.logger.critical("reload: reconcile of %s failed: %s", yaml_file, e)
+            traceback.print_exc()
+
+
+    def addStream__(self, stream):
+        name = stream["name"]
+        main_branch = self.addMainBranch__(stream)
+        self.getMultiServer(name).registerFMP4Pars(
+            **main_branch.getFMP4ShmemPars()
+        )
+        self.attachDetector__(stream)
+        self.attachTap__(stream)
+        self.attachMosaicTiles__(name)
+        main_branch() # starts MainBranch threads
+
+
+    def removeStream__(self, name):
+        """All shmem clients are closed before closing the filterchains
+        """
+        self.detachDetector__(name)
+        self.detachTap__(name)
+        self.detachMosaicTiles__(name)
+        main_branch = self.main_branches_by_name[name]
+        # closes the websockets of the viewers
+        self.getMultiServer(name).deregisterFMP4Pars(name = main_branch.fragmp4_shmem_name)
+        self.fmp4_viewers_by_name.pop(name, None)
+        self.fmp4_deadline_by_name.pop(name, None)
+        main_branch.close()
+        self.main_branches_by_name.pop(name)
+        self.livethread_placement.remove(name)
+        if self.decoder_placement is not None:
+            self.decoder_placement.remove(name)
+
+
+    def getMultiServer(self, key):
+        """Returns the MultiServerProcess shard that owns a camera name or an uuid
+        """
+        return self.multiservers[self.shard_ring(key)]
+
+
+    def getWSRoutes(self):
+        """Returns websocket path => port for all paths not served by the first shard
+
+        Used by nginx to route websocket requests to the correct MultiServerProcess shard
+        """
+        port = self.cfg["ws_server"]["port"]
+        routes = {}
+        for stream in self.cfg["streams"]:
+            if not stream["use"]:
+                continue
+            name = stream["name"] # camera name & uuid
+            shard = self.shard_ring(name)
+            if shard > 0:
+                routes[f"/ws/stream/{name}"] = port + shard
+                routes[f"/ws/message/{name}"] = port + shard
+                routes[f"/snapshot/{name}.jpg"] = port + shard
+                routes[f"/ws/jpeg/{name}"] = port + shard
+        for mosaic in self.cfg.get("mosaics", []):
+            name = mosaic["name"]
+            shard = self.shard_ring(name)
+            if mosaic.get("use", True) and shard > 0:
+                routes[f"/snapshot/{name}.jpg"] = port + shard
+                routes[f"/ws/jpeg/{name}"] = port + shard
+        for shard in range(1, self.shard_ring.n_shards):
+            routes[f"/ws/mux/{shard}"] = port + shard
+        return routes
 
 
     def startProcesses(self):
@@ -125,6 +486,10 @@ class Manager(MainContext):
         """
         self.logger.debug("startProcesses:")
 
+        # cameras and uuids are partitioned over n_workers MultiServerProcesses
+        n_workers = self.cfg["ws_server"].get("n_workers", 1)
+        self.shard_ring = HashRing(n_workers)
+
         if self.cfg["nginx"]["use"]:
             self.logger.warning("using standalone nginx process")
             if "path" not in self.cfg["nginx"]:
@@ -133,12 +498,26 @@ class Manager(MainContext):
                 f'http://localhost:{self.cfg["nginx"]["port"]}/basic\n'
                 f'http://localhost:{self.cfg["nginx"]["port"]}/cute\n'
             )
-            self.nginx = NGWrapper(self.cfg["nginx"])
+            self.nginx = NGWrapper(self.cfg["nginx"], ws_routes = self.getWSRoutes())
         else:
             self.nginx = None
 
-        self.multiserver = MultiServerProcess()
-        self.multiserver.ignoreSIGINT()
+        self.multiservers = []
+        self.multiserver_by_pipe = {}
+        for i in range(n_workers):
+            multiserver = MultiServerProcess(
+                stats_interval = self.cfg["ws_server"].get("stats_interval", 10),
+                gop_cache_size = self.cfg["ws_server"].get("gop_cache_size", 1024*1024*8),
+                max_lag = self.cfg["ws_server"].get("max_lag", 0),
+                name = f"multiserver-{i}",
+                compression = self.cfg["ws_server"].get("compression"),
+                drain = self.cfg["ws_server"].get("drain", True),
+                replay_size = self.cfg["ws_server"].get("replay_size", 100),
+                bandwidth = self.cfg["ws_server"].get("bandwidth"),
+                jpeg_threads = self.cfg["ws_server"].get("jpeg", {}).get("n_threads", 2)
+            )
+            multiserver.ignoreSIGINT()
+            self.multiservers.append(multiserver)
 
         # lists of all (avail/non-avail) analyzer processes (per process type):
         self.process_cache = {} # key: process name, value: list
@@ -205,20 +584,27 @@ class Manager(MainContext):
                 self.master_process_cache[name].append(p)
                 self.avail_master_process_cache[name].append(p)
 
-        self.multiserver.start()
         port = self.cfg["ws_server"]["port"]
-        self.multiserver.startWServer(port=port)
+        for i, multiserver in enumerate(self.multiservers):
+            multiserver.start()
+            # shard i listens at port + i
+            multiserver.startWServer(port=port + i)
+            self.multiserver_by_pipe[multiserver.getPipe()] = multiserver
         if self.nginx:
             self.nginx.start()
         self.logger.info("startProcesses: all multiprocesses running")
 
         self.detectorsFromConfig()
+        self.tapsFromConfig()
+        self.mosaicsFromConfig()
 
 
     def startThreads(self):
         self.logger.debug("startThreads:")
-        self.livethread.startCall()
+        for livethread in self.livethreads:
+            livethread.startCall()
         for name, main_branch in self.main_branches_by_name.items():
+            self.logger.debug("camera %s: livethread %s", name, self.livethread_placement.place(name))
             main_branch() # starts MainBranch threads
 
 
@@ -228,8 +614,10 @@ class Manager(MainContext):
         if self.closed:
             return
         self.logger.debug("close: stopping processes")
-        self.multiserver.requestStop()
-        self.multiserver.waitStop()
+        for multiserver in self.multiservers:
+            multiserver.requestStop()
+        for multiserver in self.multiservers:
+            multiserver.waitStop()
         if self.nginx:
             self.nginx.stop()
 
@@ -253,29 +641,39 @@ class Manager(MainContext):
         self.logger.debug("close: stopping threads")
         for name, main_branch in self.main_branches_by_name.items():
             main_branch.close()
-        self.livethread.stopCall()
+        self.taps.close()
+        for livethread in self.livethreads:
+            livethread.stopCall()
         self.closed = True
 
     def __call__(self):
         self.loop = True
-        """Register all fmp4 channels into the websocket server
+        """Register all fmp4 channels into the websocket server shard owning the camera
         """
         for name, main_branch in self.main_branches_by_name.items():
-            self.multiserver.registerFMP4Pars(
+            self.getMultiServer(name).registerFMP4Pars(
                 **main_branch.getFMP4ShmemPars()
             )
 
         self.logger.debug("starting main loop")
         while self.loop:
+            timeout = self.timeout
+            if len(self.fmp4_deadline_by_name) > 0:
+                # wake up in time to deactivate idle fmp4 channels
+                timeout = min(timeout, max(0, min(self.fmp4_deadline_by_name.values()) - time.monotonic()))
             try:
                 rlis = [self.aux_pipe_read]
-                rlis.append(self.multiserver.getPipe())
+                rlis += list(self.multiserver_by_pipe.keys())
                 reads, writes, others = safe_select(
-                    rlis, [], [], timeout=self.timeout)
+                    rlis, [], [], timeout=timeout)
             except KeyboardInterrupt:
                 self.logger.warning("SIGTERM or CTRL-C: will exit asap")
                 self.loop = False
                 continue
+            self.deactivateIdleFMP4__()
+            if self.pending_yaml is not None:
+                yaml_file, self.pending_yaml = self.pending_yaml, None
+                self.reloadConfig__(yaml_file)
             if len(reads) < 1: # reading operation timeout
                 self.logger.debug("still alive")
                 continue
@@ -284,7 +682,7 @@ class Manager(MainContext):
                     self.logger.critical("debug mode exit")
                     self.loop = False
                     continue
-                elif r is self.multiserver.getPipe():
+                elif r in self.multiserver_by_pipe:
                     obj = r.recv()
                     self.handleMultiServerMessage__(obj)
                 else:
@@ -309,7 +707,15 @@ class Manager(MainContext):
             msg.command
             msg dict:
                 camname:
+                slot: filterchain slot of the camera, as registered to the MultiServer
+                meta: (fmp4-start only) resend ftyp & moov
+
+        fmp4-start & fmp4-stop are sent per websocket viewer.  The fmp4 shmem channel
+        is activated for the first viewer & deactivated once there has been no viewers
+        for ws_server.fmp4_linger seconds, so the muxer stays hot for reconnecting viewers
 
+        Slot numbers are never reused: messages with an old slot are from the viewers of a camera
+        that has since been removed & re-added (see reconcile) & are ignored
         """
         if msg.command in ["fmp4-start", "fmp4-stop"]:
             camname = msg["camname"]
@@ -318,12 +724,42 @@ class Manager(MainContext):
             except KeyError:
                 self.logger.warning("no such cam %s", camname)
                 return
+            if msg["slot"] != main_branch.slot:
+                self.logger.debug("%s: cam %s: stale slot %s: ignored", msg.command, camname, msg["slot"])
+                return
         if msg.command == "fmp4-start":
             # websocket has been requested from MultiServer
-            main_branch.activateFMP4ShmemChannel()
+            n = self.fmp4_viewers_by_name.get(camname, 0)
+            self.fmp4_viewers_by_name[camname] = n + 1
+            lingering = (self.fmp4_deadline_by_name.pop(camname, None) is not None)
+            if n == 0 and not lingering:
+                main_branch.activateFMP4ShmemChannel() # also sends ftyp & moov
+            elif msg["meta"]:
+                main_branch.sendFMP4Meta()
         elif msg.command == "fmp4-stop":
             # websocket has been closed at MultiServer
-            main_branch.deactivateFMP4ShmemChannel()
+            prev = self.fmp4_viewers_by_name.get(camname, 0)
+            if prev < 1:
+                self.logger.debug("fmp4-stop: cam %s has no viewers: ignored", camname)
+                return
+            n = prev - 1
+            self.fmp4_viewers_by_name[camname] = n
+            if n == 0:
+                self.fmp4_deadline_by_name[camname] = \
+                    time.monotonic() + self.cfg["ws_server"].get("fmp4_linger", 5)
+
+
+    def deactivateIdleFMP4__(self):
+        """Deactivate fmp4 shmem channels that have had no viewers for the linger time
+        """
+        now = time.monotonic()
+        for camname, deadline in list(self.fmp4_deadline_by_name.items()):
+            if now < deadline:
+                continue
+            self.fmp4_deadline_by_name.pop(camname)
+            self.logger.debug("deactivating idle fmp4 for %s", camname)
+            self.main_branches_by_name[camname].deactivateFMP4ShmemChannel()
+            self.getMultiServer(camname).fmp4Idle(camname)
 
 
     def handleMessage__(self, p: MessageProcess, msg: MessageObject):
@@ -348,7 +784,7 @@ if __name__ == "__main__":
     print("testing ws streaming")
 
     name=cfg["streams"][0]["name"]
-    port=cfg["ws_server"]["port"]
+    port=cfg["ws_server"]["port"] + manager.shard_ring(name) # port of the shard owning the camera
 
     def readsome():
         cc=0
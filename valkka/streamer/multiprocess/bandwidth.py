@@ -0,0 +1,121 @@
+"""Websocket egress bandwidth accounting & admission control
+"""
+import math, time
+
+
+class RateMeter:
+    """Exponentially decaying average of a byte rate
+
+    :param tau: time constant in seconds
+    """
+    def __init__(self, tau = 2.0):
+        self.tau = tau
+        self.value = 0 # bytes per second
+        self.total = 0 # bytes
+        self.t = time.monotonic()
+
+
+    def decay__(self, now):
+        self.value *= math.exp(-(now - self.t) / self.tau)
+        self.t = now
+
+
+    def add(self, nbytes):
+        self.decay__(time.monotonic())
+        self.value += nbytes / self.tau
+        self.total += nbytes
+
+
+    def mbps(self):
+        """Current rate in Mbit/s
+        """
+        self.decay__(time.monotonic())
+        return self.value * 8 / 1e6
+
+
+class Bandwidth:
+    """Egress accounting per websocket connection & globally, per kind of traffic ("stream" or "message")
+
+    Optionally, caps new stream viewers:
+
+    ::
+
+        max_viewers: 10         # max. viewers per camera
+        max_mbps: 100           # max. total egress in Mbit/s
+        message_headroom: 5     # Mbit/s of max_mbps reserved for results
+        over_cap: thin          # what to do with viewers over the caps:
+                                # thin = downgrade to keyframes only, reject = close the websocket
+        thin_fps: 1             # keyframes per second for thinned viewers
+        max_thinned: 10         # max. thinned viewers per camera on top of max_viewers (default: max_viewers)
+
+    :param caps: dict as above or None = no caps
+    """
+    kinds = ["stream", "message"]
+
+    def __init__(self, caps = None):
+        caps = caps or {}
+        self.max_viewers = caps.get("max_viewers")
+        self.max_mbps = caps.get("max_mbps")
+        self.message_headroom = caps.get("message_headroom", 0)
+        self.over_cap = caps.get("over_cap", "thin")
+        assert(self.over_cap in ["thin", "reject"]), f"unknown over_cap {self.over_cap}"
+        self.thin_fps = caps.get("thin_fps", 1)
+        assert(self.thin_fps > 0), "thin_fps must be > 0"
+        self.max_thinned = caps.get("max_thinned", self.max_viewers)
+        self.meters = {kind : RateMeter() for kind in self.kinds}
+        self.meter_by_websocket = {}
+
+
+    def count(self, websocket, kind, nbytes):
+        self.meters[kind].add(nbytes)
+        try:
+            meter = self.meter_by_websocket[websocket]
+        except KeyError:
+            meter = RateMeter()
+            self.meter_by_websocket[websocket] = meter
+        meter.add(nbytes)
+
+
+    def forget(self, websocket):
+        self.meter_by_websocket.pop(websocket, None)
+
+
+    def mbps(self, kind):
+        return self.meters[kind].mbps()
+
+
+    def admit(self, n_viewers, thinned = False):
+        """Admission control for a new stream viewer
+
+        Thinned viewers (asked for or downgraded) count too: a camera has max. max_viewers + max_thinned
+        viewers in total
+
+        :param n_viewers: number of current viewers of the camera (full & thinned)
+        :param thinned: the viewer asked for keyframes only
+
+        Returns None (admit as requested), "thin" (admit thinned) or "reject"
+        """
+        if self.max_thinned is not None and n_viewers >= (self.max_viewers or 0) + self.max_thinned:
+            return "reject"
+        if thinned:
+            return None
+        over = False
+        if self.max_viewers is not None and n_viewers >= self.max_viewers:
+            over = True
+        if self.max_mbps is not None and \
+            self.mbps("stream") >= self.max_mbps - self.message_headroom:
+            over = True
+        if over:
+            return self.over_cap
+        return None
+
+
+    def connections(self):
+        """Yields (websocket, Mbit/s, total bytes, write buffer size) for all connections
+        """
+        for websocket, meter in self.meter_by_websocket.items():
+            try:
+                buffered = websocket.transport.get_write_buffer_size()
+            except Exception:
+                buffered = None
+            yield websocket, meter.mbps(), meter.total, buffered
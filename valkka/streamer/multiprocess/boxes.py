@@ -0,0 +1,158 @@
+"""Minimal ISO BMFF (mp4) box helpers for frag-mp4 packets
+
+Only what's needed for rewriting a few fields of moof packets in-place:
+
+::
+
+    moof
+        mfhd        sequence_number
+        traf
+            tfhd    default_sample_duration
+            tfdt    base_media_decode_time
+            trun    sample_duration(s)
+
+and for reading the timescale from moov/trak/mdia/mdhd.
+
+Also creates emsg (event message) boxes, for embedding timed metadata into the stream.
+"""
+import struct
+
+CONTAINERS = {b"moov", b"trak", b"mdia", b"minf", b"stbl", b"moof", b"traf", b"mvex", b"edts", b"dinf"}
+
+
+def iterBoxes(data, start = 0, end = None):
+    """Yields (box type, start, end, payload start) for the boxes in data[start:end]
+    """
+    if end is None:
+        end = len(data)
+    pos = start
+    while pos + 8 <= end:
+        size, type_ = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from(">Q", data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return # corrupt box
+        yield type_, pos, pos + size, pos + header
+        pos += size
+
+
+def findBox(data, path, start = 0, end = None):
+    """Returns (start, end, payload start) of the first box at path, say [b"moof", b"traf", b"tfdt"]
+    or None if not found
+    """
+    for type_, box_start, box_end, payload in iterBoxes(data, start, end):
+        if type_ != path[0]:
+            continue
+        if len(path) == 1:
+            return box_start, box_end, payload
+        if type_ in CONTAINERS:
+            found = findBox(data, path[1:], payload, box_end)
+            if found is not None:
+                return found
+    return None
+
+
+def timescale(moov):
+    """Returns the timescale of the (first) track in a moov packet or None
+    """
+    found = findBox(moov, [b"moov", b"trak", b"mdia", b"mdhd"])
+    if found is None:
+        return None
+    _, _, payload = found
+    version = moov[payload]
+    if version == 1:
+        return struct.unpack_from(">I", moov, payload + 4 + 16)[0]
+    return struct.unpack_from(">I", moov, payload + 4 + 8)[0]
+
+
+def setSequenceNumber(moof, seq):
+    """Rewrite moof/mfhd sequence_number of moof (a bytearray).  Returns False if there's no mfhd
+    """
+    found = findBox(moof, [b"moof", b"mfhd"])
+    if found is None:
+        return False
+    _, _, payload = found
+    struct.pack_into(">I", moof, payload + 4, seq & 0xffffffff)
+    return True
+
+
+def getDecodeTime(moof):
+    """Returns moof/traf/tfdt base_media_decode_time or None
+    """
+    found = findBox(moof, [b"moof", b"traf", b"tfdt"])
+    if found is None:
+        return None
+    _, _, payload = found
+    if moof[payload] == 1:
+        return struct.unpack_from(">Q", moof, payload + 4)[0]
+    return struct.unpack_from(">I", moof, payload + 4)[0]
+
+
+def setDecodeTime(moof, t):
+    """Rewrite moof/traf/tfdt base_media_decode_time of moof (a bytearray)
+    """
+    found = findBox(moof, [b"moof", b"traf", b"tfdt"])
+    if found is None:
+        return False
+    _, _, payload = found
+    if moof[payload] == 1:
+        struct.pack_into(">Q", moof, payload + 4, t)
+    else:
+        struct.pack_into(">I", moof, payload + 4, t & 0xffffffff)
+    return True
+
+
+def setSampleDuration(moof, duration):
+    """Rewrite the sample duration of a single-sample moof (a bytearray)
+
+    Uses trun's per-sample duration if present, otherwise tfhd's default_sample_duration.
+    Returns False if neither is present or there are several samples
+    """
+    found = findBox(moof, [b"moof", b"traf", b"trun"])
+    if found is None:
+        return False
+    _, _, payload = found
+    flags, sample_count = struct.unpack_from(">II", moof, payload)
+    flags &= 0xffffff
+    if sample_count != 1:
+        return False
+    if flags & 0x100: # sample-duration-present
+        pos = payload + 8
+        if flags & 0x1: # data-offset-present
+            pos += 4
+        if flags & 0x4: # first-sample-flags-present
+            pos += 4
+        struct.pack_into(">I", moof, pos, duration)
+        return True
+    found = findBox(moof, [b"moof", b"traf", b"tfhd"])
+    if found is None:
+        return False
+    _, _, payload = found
+    flags = struct.unpack_from(">I", moof, payload)[0] & 0xffffff
+    if not flags & 0x8: # default-sample-duration-present
+        return False
+    pos = payload + 8 # version & flags, track_ID
+    if flags & 0x1: # base-data-offset-present
+        pos += 8
+    if flags & 0x2: # sample-description-index-present
+        pos += 4
+    struct.pack_into(">I", moof, pos, duration)
+    return True
+
+
+def makeEmsg(timescale, presentation_time, message_data, scheme_id_uri, value = "", event_duration = 0, id_ = 0):
+    """Returns a version 1 emsg box (bytes)
+
+    :param timescale: ticks per second of presentation_time & event_duration
+    :param presentation_time: media time of the event, in timescale units
+    :param message_data: bytes
+    :param scheme_id_uri: identifies the type of the event
+    """
+    # version 1, flags 0
+    payload = struct.pack(">B3xIQII", 1, timescale, presentation_time, event_duration, id_ & 0xffffffff) \
+        + scheme_id_uri.encode("utf-8") + b"\0" + value.encode("utf-8") + b"\0" + message_data
+    return struct.pack(">I4s", 8 + len(payload), b"emsg") + payload
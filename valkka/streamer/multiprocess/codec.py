@@ -0,0 +1,158 @@
+"""Encoding of analyzer results for websockets
+
+The encoding is negotiated with the websocket subprotocol (Sec-WebSocket-Protocol):
+
+::
+
+    (none) or valkka.json   results as json text (the default)
+    valkka.msgpack          results as msgpack (needs the msgpack module)
+    valkka.cbor             results as CBOR (needs the cbor2 module)
+
+With json, numpy arrays are sent as lists & bytes as base64 strings.
+
+With the binary encodings, each result is sent as an envelope
+
+::
+
+    {"data": result, "attachments": n}
+
+followed by n raw binary websocket messages.  Numpy arrays & bytes larger than
+ATTACHMENT_MIN_SIZE are not encoded into the envelope, but replaced with
+
+::
+
+    {"$attachment": i, "dtype": "uint8", "shape": [480, 640, 3]}  # numpy array
+    {"$attachment": i}                                            # bytes
+
+where i is the index of the attachment message.  Smaller numpy arrays are sent as lists.
+
+Each result has a sequence number (running per uuid).  With json, it's added as "seq" into
+results that are dicts.  With the binary encodings, it's in the envelope:
+
+::
+
+    {"data": result, "attachments": n, "seq": seq}
+
+With delta encoding, unchanged results are not sent: see delta.py for telling those gaps from lost results.
+
+With msgpack, floats are sent in single precision (plenty for bbox coordinates & scores).
+"""
+import json, base64, pickle
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+JSON = "valkka.json"
+MSGPACK = "valkka.msgpack"
+CBOR = "valkka.cbor"
+
+ATTACHMENT_MIN_SIZE = 1024 # bytes
+
+
+def availableSubprotocols():
+    """Subprotocols supported by this installation, in the order of preference
+    """
+    subprotocols = []
+    if msgpack is not None:
+        subprotocols.append(MSGPACK)
+    if cbor2 is not None:
+        subprotocols.append(CBOR)
+    subprotocols.append(JSON)
+    return subprotocols
+
+
+def jsonDefault(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode("ascii")
+    raise TypeError(f"can't encode {type(obj)}")
+
+
+def detach(obj, attachments):
+    """Returns a copy of obj where large numpy arrays & bytes have been moved into attachments
+    """
+    if isinstance(obj, dict):
+        return {key : detach(value, attachments) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [detach(value, attachments) for value in obj]
+    if isinstance(obj, np.ndarray):
+        if obj.nbytes < ATTACHMENT_MIN_SIZE:
+            return obj.tolist()
+        attachments.append(np.ascontiguousarray(obj).tobytes())
+        return {"$attachment" : len(attachments) - 1, "dtype" : obj.dtype.str, "shape" : list(obj.shape)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        if len(obj) < ATTACHMENT_MIN_SIZE:
+            return bytes(obj)
+        attachments.append(bytes(obj))
+        return {"$attachment" : len(attachments) - 1}
+    return obj
+
+
+def encode(subprotocol, obj, seq = None):
+    """Returns a list of websocket messages for a result object
+
+    :param subprotocol: negotiated subprotocol or None (= json)
+    :param seq: sequence number of the result or None
+    """
+    if subprotocol is None or subprotocol == JSON:
+        if seq is not None and isinstance(obj, dict):
+            obj = dict(obj, seq = seq)
+        return [json.dumps(obj, default = jsonDefault)]
+    attachments = []
+    envelope = {"data" : detach(obj, attachments), "attachments" : len(attachments)}
+    if seq is not None:
+        envelope["seq"] = seq
+    if subprotocol == MSGPACK:
+        return [msgpack.packb(envelope, use_single_float = True)] + attachments
+    if subprotocol == CBOR:
+        return [cbor2.dumps(envelope)] + attachments
+    raise ValueError(f"unknown subprotocol {subprotocol}")
+
+
+class Message:
+    """A result object that is encoded at most once per subprotocol, no matter
+    how many websockets it's sent to
+
+    Messages derived from this one (say, delta-encoded versions) can be cached into derived
+
+    :param obj: the result object
+    :param raw: .. or the pickled result object, as it came from shmem.  Unpickled only if needed
+    :param seq: sequence number
+    """
+    __slots__ = ["obj_", "raw", "seq", "encoded", "derived"]
+
+    def __init__(self, obj = None, raw = None, seq = None):
+        self.obj_ = obj
+        self.raw = raw
+        self.seq = seq
+        self.encoded = {}
+        self.derived = {}
+
+    @property
+    def obj(self):
+        if self.raw is not None:
+            self.obj_ = pickle.loads(self.raw)
+            self.raw = None
+        return self.obj_
+
+    def encode(self, subprotocol):
+        try:
+            return self.encoded[subprotocol]
+        except KeyError:
+            messages = encode(subprotocol, self.obj, seq = self.seq)
+            self.encoded[subprotocol] = messages
+            return messages
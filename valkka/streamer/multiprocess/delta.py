@@ -0,0 +1,131 @@
+"""Delta encoding of detection results
+
+Analyzers send the full list of detections for every frame:
+
+::
+
+    {"detections": [["car", left, right, top, bottom], ..]}
+
+In delta mode, the server remembers what each websocket client has already got and sends only
+the changes.  Objects get an id (unique per client):
+
+::
+
+    {"delta": "full", "detections": {"1": ["car", left, right, top, bottom], ..}}
+    {"delta": "diff", "base": 1233, "add": {"3": ["person", ..]}, "remove": ["1"], "move": {"2": [left, right, top, bottom]}}
+
+A "full" message is sent first and then every keyframe_interval seconds, so that a client can always
+resync.  A "diff" with no changes is not sent at all, so there are gaps in the sequence numbers
+(see codec.py).  A "diff" is relative to the message with sequence number "base": if that's the latest
+message the client got, the gap is due to suppressed messages.  Otherwise messages were lost & the
+client should wait for the next "full" one.  Any other keys in the result are passed as-is
+(but a changed "mstimestamp" alone doesn't count as a change).
+
+A new detection matches an old one if it has the same tag & all of its coordinates are within max_move
+from the old ones.  Movement is reported only if some coordinate has changed more than tolerance.
+"""
+import time
+from valkka.streamer.multiprocess.codec import Message
+
+
+class DetectionState:
+    """Detections as the client has them: id => [tag, left, right, top, bottom]
+    """
+    __slots__ = ["detections", "next_id", "seq"]
+
+    def __init__(self, detections = {}, next_id = 1, seq = None):
+        self.detections = detections
+        self.next_id = next_id
+        self.seq = seq # sequence number of the latest message sent to the client
+
+
+def distance(a, b):
+    return max(abs(x - y) for x, y in zip(a[1:], b[1:]))
+
+
+def diff(state, detections, tolerance, max_move):
+    """Returns (new state, added, removed, moved)
+    """
+    old = dict(state.detections)
+    pairs = []
+    for i, det in enumerate(detections):
+        for id_, old_det in old.items():
+            if det[0] == old_det[0]:
+                d = distance(det, old_det)
+                if d <= max_move:
+                    pairs.append((d, i, id_))
+    pairs.sort(key = lambda pair: pair[0]) # closest matches first
+    new = {}
+    added, moved = {}, {}
+    matched = set()
+    for d, i, id_ in pairs:
+        if i in matched or id_ not in old:
+            continue
+        matched.add(i)
+        if d > tolerance:
+            new[id_] = list(detections[i])
+            moved[id_] = list(detections[i][1:])
+        else:
+            new[id_] = old[id_] # client keeps the old coordinates
+        old.pop(id_)
+    next_id = state.next_id
+    for i, det in enumerate(detections):
+        if i not in matched:
+            id_ = str(next_id)
+            next_id += 1
+            new[id_] = list(det)
+            added[id_] = list(det)
+    removed = list(old.keys())
+    return DetectionState(new, next_id), added, removed, moved
+
+
+class DeltaEncoder:
+    """Delta-encodes the detection results sent to a single client
+
+    The result of a (state, message) pair is cached into the message, so clients that are
+    in the same state share the work
+
+    :param tolerance: min. movement (in relative coordinates) that is reported
+    :param max_move: max. movement (in relative coordinates) of an object between two results.
+                     Bigger jumps are reported as remove + add
+    :param keyframe_interval: send full state every this many seconds
+    """
+    def __init__(self, tolerance = 0.01, max_move = 0.2, keyframe_interval = 10):
+        self.tolerance = tolerance
+        self.max_move = max_move
+        self.keyframe_interval = keyframe_interval
+        self.state = None
+        self.keyframe_time = 0
+
+
+    def __call__(self, message):
+        """Returns a delta-encoded Message or None if there's nothing to send
+        """
+        obj = message.obj
+        if not isinstance(obj, dict) or not isinstance(obj.get("detections"), list):
+            return message # not a detection result
+        now = time.monotonic()
+        full = (self.state is None) or (now - self.keyframe_time >= self.keyframe_interval)
+        key = ("delta", self.state, full)
+        try:
+            state, delta_message = message.derived[key]
+        except KeyError:
+            prev = self.state or DetectionState()
+            state, added, removed, moved = diff(prev, obj["detections"], self.tolerance, self.max_move)
+            delta_obj = {key_ : value for key_, value in obj.items() if key_ != "detections"}
+            state.seq = message.seq
+            if full:
+                delta_obj.update({"delta" : "full", "detections" : state.detections})
+                delta_message = Message(delta_obj, seq = message.seq)
+            elif len(added) + len(removed) + len(moved) > 0 or len(set(delta_obj) - {"mstimestamp"}) > 0:
+                delta_obj.update({"delta" : "diff", "base" : prev.seq,
+                    "add" : added, "remove" : removed, "move" : moved})
+                delta_message = Message(delta_obj, seq = message.seq)
+            else:
+                delta_message = None # no changes
+                state.seq = prev.seq
+            message.derived[key] = (state, delta_message)
+        self.state = state
+        if full:
+            self.keyframe_time = now
+        return delta_message
@@ -0,0 +1,617 @@
+import asyncio, time
+from collections import deque
+from valkka.streamer.multiprocess.delta import DeltaEncoder
+from valkka.streamer.multiprocess import boxes, codec
+
+
+class FragRing:
+    """A ringbuffer of frag-mp4 packets, shared by all websocket subscribers of a single camera
+
+    Each packet is written once into the ring.  Subscribers only keep a read
+    cursor (a running sequence number), so N viewers cost one copy per packet
+    instead of N.
+
+    ::
+
+        tail                                          head
+         |                                             |
+        [packet][packet][packet] ... [packet][packet]
+                   ^                    ^
+                   subscriber A         subscriber B
+
+    Packets with sequence number seq live in the slot seq % maxlen.  Sequence numbers
+    in the range [tail, head) are available for reading.
+
+    The ring also remembers where the keyframes (i.e. the GOPs) start, so that new
+    subscribers can start reading from the latest one (see subscribe) and lagging
+    subscribers can skip forward GOP-wise (see Subscriber).  If the current GOP doesn't
+    fit into maxbytes, it's not cached.  The size of the latest complete GOP is kept in gop_bytes
+
+    With maxbytes, maxlen is just the initial number of slots: the ring grows (doubles) when it's
+    full of packets, but not of bytes, so that long GOPs or GOPs of many small fragments stay cached.
+
+    :param maxlen: number of packets in the ringbuffer (initial number, if maxbytes is set)
+    :param maxbytes: maximum total payload size in the ringbuffer.  None = no limit
+    """
+    def __init__(self, maxlen = 100, maxbytes = None):
+        self.maxlen = maxlen
+        self.maxbytes = maxbytes
+        self.slots = [None] * maxlen
+        self.keys = [False] * maxlen # is the packet a keyframe
+        self.offsets = [0] * maxlen # running byte count before the packet
+        self.tail = 0 # oldest sequence number still in the ring
+        self.head = 0 # sequence number of the next packet to be written
+        self.key_seqs = deque() # sequence numbers of the keyframes in the ring
+        self.nbytes = 0 # payload bytes in the ring
+        self.total = 0 # running byte count of all packets ever written
+        self.key_total = None # running byte count before the latest keyframe
+        self.gop_bytes = 0 # payload bytes of the latest complete GOP.  0 = not known yet
+        self.subscribers = set()
+
+
+    def dropTail__(self):
+        i = self.tail % self.maxlen
+        meta, payload = self.slots[i]
+        self.nbytes -= len(payload)
+        self.slots[i] = None
+        self.keys[i] = False
+        self.tail += 1
+        while len(self.key_seqs) > 0 and self.key_seqs[0] < self.tail:
+            self.key_seqs.popleft()
+
+
+    def grow__(self):
+        maxlen = 2 * self.maxlen
+        slots, keys, offsets = [None] * maxlen, [False] * maxlen, [0] * maxlen
+        for seq in range(self.tail, self.head):
+            i, j = seq % self.maxlen, seq % maxlen
+            slots[j], keys[j], offsets[j] = self.slots[i], self.keys[i], self.offsets[i]
+        self.maxlen, self.slots, self.keys, self.offsets = maxlen, slots, keys, offsets
+
+
+    def push(self, meta, payload, key = False):
+        """Write a (meta, payload) packet into the ring & wake up all subscribers
+
+        :param key: True if this packet starts a new GOP (i.e. is a keyframe moof)
+        """
+        if self.head - self.tail >= self.maxlen:
+            if self.maxbytes is not None and self.nbytes + len(payload) <= self.maxbytes:
+                self.grow__()
+            else:
+                self.dropTail__()
+        i = self.head % self.maxlen
+        self.slots[i] = (meta, payload)
+        self.keys[i] = key
+        self.offsets[i] = self.total
+        self.nbytes += len(payload)
+        self.total += len(payload)
+        if key:
+            self.key_seqs.append(self.head)
+            if self.key_total is not None:
+                self.gop_bytes = self.offsets[i] - self.key_total
+            self.key_total = self.offsets[i]
+        self.head += 1
+        if self.maxbytes is not None:
+            while self.nbytes > self.maxbytes and self.tail < self.head - 1:
+                self.dropTail__()
+        for subscriber in self.subscribers:
+            subscriber.event.set()
+
+
+    def get(self, seq):
+        """Returns packet with sequence number seq or None if not in the ring
+        """
+        if seq < self.tail or seq >= self.head:
+            return None
+        return self.slots[seq % self.maxlen]
+
+
+    def isKey(self, seq):
+        if seq < self.tail or seq >= self.head:
+            return False
+        return self.keys[seq % self.maxlen]
+
+
+    def latestKey(self):
+        """Sequence number of the latest keyframe in the ring or None
+        """
+        if len(self.key_seqs) < 1:
+            return None
+        return self.key_seqs[-1]
+
+
+    def bytesFrom(self, seq):
+        """Payload bytes in the ring from sequence number seq up to the head
+        """
+        seq = max(seq, self.tail)
+        if seq >= self.head:
+            return 0
+        return self.total - self.offsets[seq % self.maxlen]
+
+
+    def subscribe(self, event = None, from_key = False, max_lag = None, name = None):
+        """Returns a new Subscriber, reading from the head of the ring
+
+        :param event: an asyncio.Event that is set when new packets arrive.  Can be
+                      shared between several rings, so that a single task can wait
+                      for packets from many cameras
+        :param from_key: start reading from the latest cached keyframe instead of the
+                         head of the ring (if there is one)
+        :param max_lag: see Subscriber
+        :param name: a name for the subscriber (for logging)
+        """
+        subscriber = Subscriber(self, event = event, max_lag = max_lag, name = name)
+        key = self.latestKey()
+        if from_key and key is not None:
+            subscriber.cursor = key
+        self.subscribers.add(subscriber)
+        return subscriber
+
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+
+    def numSubscribers(self):
+        return len(self.subscribers)
+
+
+    def clear(self):
+        self.slots = [None] * self.maxlen
+        self.keys = [False] * self.maxlen
+        self.tail = self.head
+        self.key_seqs.clear()
+        self.key_total = None
+        self.nbytes = 0
+
+
+class Subscriber:
+    """A read cursor into a FragRing
+
+    Don't instantiate directly, but use FragRing.subscribe
+
+    When a subscriber falls behind (its packets have been overwritten in the ring or it lags more
+    than max_lag bytes), it never just drops the oldest packets, as that could drop a keyframe,
+    while keeping the packets that depend on it.  Instead, the rest of the current GOP is skipped
+    and reading continues from the latest keyframe in the ring (or, if there is none, from the next
+    keyframe to arrive).
+
+    A moof & its mdat are read as a unit: the moof is returned only once its mdat is in the ring
+    & the mdat is held by the subscriber, so that it's returned by the next pull, even if the ring
+    has been overrun in between.  Skipping forward hence happens only at fragment boundaries, as an
+    orphaned moof or mdat corrupts the MSE stream of the viewer.
+
+    :param max_lag: max. payload bytes this subscriber can lag behind the head of the ring
+                    before skipping forward.  None = lag_gops times the size of the latest
+                    complete GOP in the ring (no skipping until a GOP has been seen)
+    """
+    lag_gops = 2 # default max. lag in GOPs
+
+    def __init__(self, ring, event = None, max_lag = None, name = None):
+        self.ring = ring
+        self.cursor = ring.head
+        if event is None:
+            event = asyncio.Event()
+        self.event = event
+        self.max_lag = max_lag
+        self.name = name
+        self.need_key = False # skipping packets until next keyframe
+        self.mdat = None # mdat of the latest moof, returned by the next pull
+        self.drops = 0 # number of packets skipped
+        self.skips = 0 # number of times skipped forward
+
+
+    def skipToKey__(self):
+        ring = self.ring
+        key = ring.latestKey()
+        if key is not None and key >= self.cursor:
+            self.drops += key - self.cursor
+            self.cursor = key
+        else:
+            # mid-GOP: drop the rest of it & wait for the next keyframe
+            self.drops += ring.head - self.cursor
+            self.cursor = ring.head
+            self.need_key = True
+        self.skips += 1
+
+
+    def maxLag(self):
+        """Max. payload bytes this subscriber can lag behind before skipping forward or None
+        """
+        if self.max_lag is not None:
+            return self.max_lag
+        if self.ring.gop_bytes > 0:
+            return self.lag_gops * self.ring.gop_bytes
+        return None
+
+
+    def pull(self):
+        """Returns next (meta, payload) packet or None if there are no new packets (non-blocking)
+        """
+        if self.mdat is not None:
+            item, self.mdat = self.mdat, None
+            return item
+        ring = self.ring
+        max_lag = self.maxLag()
+        if self.cursor < ring.tail:
+            # packets were overwritten before we could read them
+            self.skipToKey__()
+        elif max_lag is not None and ring.bytesFrom(self.cursor) > max_lag:
+            self.skipToKey__()
+        while self.cursor < ring.head:
+            seq = self.cursor
+            if self.need_key and not ring.isKey(seq):
+                self.cursor += 1
+                self.drops += 1
+                continue
+            item = ring.get(seq)
+            if item[0].name == "moof":
+                if seq + 1 >= ring.head:
+                    return None # wait for the mdat
+                mdat = ring.get(seq + 1)
+                if mdat[0].name == "mdat":
+                    self.mdat = mdat
+                    self.cursor += 1
+            self.cursor += 1
+            self.need_key = False
+            return item
+        return None
+
+
+    async def get(self):
+        """Returns next (meta, payload) packet, waiting for one if necessary
+        """
+        while True:
+            item = self.pull()
+            if item is not None:
+                return item
+            self.event.clear()
+            await self.event.wait()
+
+
+    def lag(self):
+        """Number of packets in the ring not yet read by this subscriber
+        """
+        return self.ring.head - max(self.cursor, self.ring.tail) + (self.mdat is not None)
+
+
+    def lagBytes(self):
+        """Payload bytes in the ring not yet read by this subscriber
+        """
+        return self.ring.bytesFrom(self.cursor)
+
+
+class FMP4Viewer:
+    """Frag-mp4 state of a single viewer, reading from a FragRing through a Subscriber
+
+    Makes sure that the viewer first gets ftyp & moov and then starts from a keyframe.
+    Metadata resent for other viewers is not passed again to this viewer.
+
+    ::
+
+        viewer = FMP4Viewer(ring.subscribe(..), metadata)
+        while True:
+            meta, packet = await viewer.subscriber.get()
+            for payload in viewer.filter(meta, packet):
+                await websocket.send(payload)
+
+    :param subscriber: a Subscriber
+    :param metadata: dict with the latest cached "ftyp" & "moov" payloads of the camera
+    """
+    def __init__(self, subscriber, metadata):
+        self.subscriber = subscriber
+        self.metadata = metadata
+        self.ftyp = metadata.get("ftyp") # cached ftyp & moov, if any
+        self.moov = metadata.get("moov")
+        self.key = False # got keyframe
+        self.init_ = False # ftyp & moov sent to the viewer
+        self.drops = 0
+
+
+    def filter(self, meta, packet):
+        """Returns a list of payloads to be sent to the viewer for this packet
+        """
+        if self.init_ and meta.name in ["ftyp", "moov"]:
+            if packet == self.ftyp or packet == self.moov:
+                # metadata resent for another subscriber: no need to re-init this one
+                return []
+
+        if meta.name == "ftyp":
+            self.init_ = False
+            self.moov = None
+            self.key = False
+            self.ftyp = packet
+            return []
+
+        if meta.name == "moov":
+            self.key = False
+            self.moov = packet
+            return []
+
+        if meta.name == "moof":
+            if self.subscriber.drops != self.drops:
+                # subscriber was skipped forward to this keyframe: it might have missed ftyp & moov
+                self.drops = self.subscriber.drops
+                if self.metadata.get("ftyp") != self.ftyp or self.metadata.get("moov") != self.moov:
+                    self.ftyp = self.metadata.get("ftyp")
+                    self.moov = self.metadata.get("moov")
+                    self.init_ = False
+                    self.key = False
+            if (not self.key) and (self.ftyp is not None) and (self.moov is not None) and meta.is_first:
+                # == keyframe not yet received, but ftyp & moov cached & just got moof keyframe
+                self.key = True
+
+        if not self.key:
+            # no keyframe received yet
+            return []
+
+        if not self.init_:
+            self.init_ = True
+            return [self.ftyp, self.moov, packet]
+        return [packet]
+
+
+class KeyframeViewer(FMP4Viewer):
+    """A thinned frag-mp4 viewer that gets only keyframes, max. fps per second
+
+    The keyframe moofs are rewritten, so that the browser sees a continuous stream:
+
+    - mfhd sequence numbers are consecutive
+    - tfdt decode times are contiguous & the (single) sample lasts until the next keyframe
+      (estimated from the previous interval between keyframes)
+
+    :param fps: max. keyframes per second
+    """
+    def __init__(self, subscriber, metadata, fps = 1):
+        assert(fps > 0), "KeyframeViewer needs fps > 0"
+        super().__init__(subscriber, metadata)
+        self.interval = 1000 / fps # ms
+        self.sent_time = None # mstimestamp of the latest keyframe sent
+        self.pass_mdat = False # mdat of a keyframe that was sent
+        self.seq = 0 # mfhd sequence number
+        self.decode_time = None # tfdt of the next keyframe
+        self.skipped = 0 # number of keyframes skipped
+
+
+    def rewrite__(self, meta, packet):
+        moof = bytearray(packet) # moofs are small
+        self.seq += 1
+        boxes.setSequenceNumber(moof, self.seq)
+        timescale = boxes.timescale(self.moov) if self.moov is not None else None
+        if timescale is not None:
+            if self.sent_time is None:
+                elapsed = self.interval
+            else:
+                elapsed = meta.mstimestamp - self.sent_time
+            duration = max(1, int(elapsed * timescale / 1000))
+            if self.decode_time is None:
+                self.decode_time = boxes.getDecodeTime(moof) or 0
+            boxes.setDecodeTime(moof, self.decode_time)
+            boxes.setSampleDuration(moof, duration)
+            self.decode_time += duration
+        return bytes(moof)
+
+
+    def filter(self, meta, packet):
+        if meta.name in ["ftyp", "moov"]:
+            if meta.name == "ftyp" and not (self.init_ and packet == self.ftyp):
+                self.decode_time = None # new stream: new timeline
+            return super().filter(meta, packet)
+        if meta.name == "moof":
+            self.pass_mdat = False
+            if not meta.is_first:
+                return []
+            if self.sent_time is not None and meta.mstimestamp - self.sent_time < self.interval:
+                self.skipped += 1
+                return []
+            payloads = super().filter(meta, packet)
+            if len(payloads) > 0:
+                payloads[-1] = self.rewrite__(meta, packet)
+                self.sent_time = meta.mstimestamp
+                self.pass_mdat = True
+            return payloads
+        if meta.name == "mdat" and self.pass_mdat:
+            self.pass_mdat = False
+            return super().filter(meta, packet)
+        return []
+
+
+class EmsgInjector:
+    """Embeds analyzer results into the frag-mp4 stream of a viewer as emsg boxes
+
+    The results that have arrived since the previous moof are sent as emsg boxes right before
+    the next moof.  The presentation time of a result is mapped from its "mstimestamp" (of the
+    analyzed frame) into the media timeline, using the moof as the reference:
+
+    ::
+
+        presentation_time = tfdt + (result mstimestamp - moof mstimestamp) * timescale / 1000
+
+    Results without mstimestamp get the presentation time of the moof.  The message_data
+    of an emsg is the result as utf-8 json (see codec.py) & its id is the sequence number of the result
+
+    :param subscriber: a MessageSubscriber of the results
+    """
+    scheme_id_uri = "urn:valkka:streamer:result"
+
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+        self.moov = None
+        self.timescale = None
+
+
+    def inject(self, viewer, meta, payloads):
+        """Returns the payloads (from viewer.filter) with emsg boxes inserted before the moof
+        """
+        if meta.name != "moof" or len(payloads) < 1 or viewer.moov is None:
+            return payloads
+        if viewer.moov is not self.moov:
+            self.moov = viewer.moov
+            self.timescale = boxes.timescale(self.moov)
+        moof = payloads[-1] # .. after ftyp & moov, if any
+        decode_time = boxes.getDecodeTime(moof)
+        if self.timescale is None or decode_time is None:
+            return payloads
+        emsgs = []
+        while True:
+            message = self.subscriber.pull()
+            if message is None:
+                break
+            obj = message.obj
+            presentation_time = decode_time
+            if isinstance(obj, dict) and "mstimestamp" in obj:
+                presentation_time = max(0, decode_time +
+                    int((obj["mstimestamp"] - meta.mstimestamp) * self.timescale / 1000))
+            emsgs.append(boxes.makeEmsg(self.timescale, presentation_time,
+                message.encode(codec.JSON)[0].encode("utf-8"), self.scheme_id_uri,
+                id_ = message.seq or 0))
+        return payloads[:-1] + emsgs + payloads[-1:]
+
+
+class MessageChannel:
+    """Fans out messages (say, analyzer results of a single uuid) to all subscribers
+
+    Each subscriber has its own bounded queue: a slow subscriber loses its oldest messages,
+    without affecting the others.
+
+    Delivery modes:
+
+    ::
+
+        all     every message is delivered, in order
+        latest  only the newest message at send time is delivered: older ones are dropped
+        rate    like latest, but max. max_rate messages per second are delivered
+
+    Messages are codec.Message objects.  Detection results can be delta-encoded per subscriber (see delta.py)
+
+    Each message gets a running sequence number.  The latest replay_size messages are kept
+    in a replay ring, so that a reconnecting subscriber can resume from where it left
+    (see subscribe)
+
+    :param maxlen: max. number of queued messages per subscriber (mode "all")
+    :param mode: delivery mode
+    :param max_rate: messages per second (mode "rate")
+    :param delta: None or a dict of DeltaEncoder parameters to enable delta encoding
+    :param replay_size: number of messages in the replay ring.  0 = no replay
+    """
+    modes = ["all", "latest", "rate"]
+
+    def __init__(self, maxlen = 100, mode = "all", max_rate = None, delta = None, replay_size = 0):
+        assert(mode in self.modes), f"unknown delivery mode {mode}"
+        if mode == "rate":
+            assert(max_rate is not None and max_rate > 0), "delivery mode rate needs max_rate"
+        self.maxlen = maxlen if mode == "all" else 1
+        self.mode = mode
+        self.min_interval = 1 / max_rate if mode == "rate" else None
+        self.delta = delta
+        self.seq = 0 # sequence number of the latest message
+        self.replay = deque(maxlen = replay_size) if replay_size > 0 else None
+        self.subscribers = set()
+
+
+    def push(self, message):
+        self.seq += 1
+        message.seq = self.seq
+        if self.replay is not None:
+            self.replay.append(message)
+        for subscriber in self.subscribers:
+            subscriber.put(message)
+
+
+    def subscribe(self, event = None, name = None, from_seq = None):
+        """Returns a new MessageSubscriber
+
+        :param event: an asyncio.Event that is set when new messages arrive (see FragRing.subscribe)
+        :param name: a name for the subscriber (for logging)
+        :param from_seq: resume after this sequence number, i.e. first replay all messages
+                         newer than from_seq still in the replay ring.  None = start from new messages
+        """
+        subscriber = MessageSubscriber(self, event = event, name = name)
+        if from_seq is not None and self.replay is not None:
+            for message in self.replay:
+                if message.seq > from_seq:
+                    subscriber.put(message)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        self.subscribers.discard(subscriber)
+
+
+    def numSubscribers(self):
+        return len(self.subscribers)
+
+
+class MessageSubscriber:
+    """A message queue of a single subscriber.  Don't instantiate directly, but use MessageChannel.subscribe
+    """
+    def __init__(self, channel, event = None, name = None):
+        self.channel = channel
+        self.queue = deque(maxlen = channel.maxlen)
+        if event is None:
+            event = asyncio.Event()
+        self.event = event
+        self.name = name
+        self.drops = 0 # number of messages lost (or conflated)
+        self.next_time = 0 # mode "rate": next message can be delivered at this time
+        self.timer = None # mode "rate": wakes up the subscriber at next_time
+        if channel.delta is not None:
+            self.delta = DeltaEncoder(**channel.delta)
+        else:
+            self.delta = None
+
+
+    def put(self, obj):
+        if len(self.queue) >= self.channel.maxlen:
+            self.drops += 1
+        self.queue.append(obj)
+        self.event.set()
+
+
+    def wake__(self):
+        self.timer = None
+        self.event.set()
+
+
+    def pull(self):
+        """Returns next message or None if there are no new messages (non-blocking)
+
+        In mode "rate", returns None also if it's too early to deliver the next message:
+        the event is then set once it's time
+        """
+        min_interval = self.channel.min_interval
+        while len(self.queue) > 0:
+            if min_interval is not None:
+                now = time.monotonic()
+                if now < self.next_time:
+                    if self.timer is None:
+                        self.timer = asyncio.get_event_loop().call_later(self.next_time - now, self.wake__)
+                    return None
+            message = self.queue.popleft()
+            if self.delta is not None:
+                message = self.delta(message)
+                if message is None:
+                    continue # no changes
+            if min_interval is not None:
+                self.next_time = now + min_interval
+            return message
+        return None
+
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+    async def get(self):
+        """Returns next message, waiting for one if necessary
+        """
+        while True:
+            obj = self.pull()
+            if obj is not None:
+                return obj
+            self.event.clear()
+            await self.event.wait()
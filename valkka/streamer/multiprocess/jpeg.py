@@ -0,0 +1,86 @@
+"""Latest-frame cache with JPEG encoding, shared by all HTTP snapshot & JPEG stream viewers
+"""
+import asyncio, io
+from PIL import Image
+
+
+def encodeJPEG(frame, quality = 80):
+    """RGB24 numpy array => JPEG bytes.  Runs in a worker thread (Pillow releases the GIL while encoding)
+    """
+    f = io.BytesIO()
+    Image.fromarray(frame).save(f, format = "JPEG", quality = quality)
+    return f.getvalue()
+
+
+class JPEGSource:
+    """The latest frame of a camera (or a mosaic) & its JPEG encoding
+
+    Each frame is encoded at most once, no matter how many clients ask for it: the JPEG is cached
+    until a newer frame arrives & concurrent requests for the same frame wait for the same encoding.
+    So the encoding cost depends on the number of cameras & their frame rate, not on the number of viewers.
+
+    JPEG stream viewers subscribe an asyncio.Event that is set when a new frame arrives
+    (or when the source is closed).
+
+    :param executor: a concurrent.futures executor for the encoding
+    :param quality: JPEG quality 1..95
+    """
+    def __init__(self, executor, quality = 80):
+        self.executor = executor
+        self.quality = quality
+        self.frame = None # latest frame: must not be modified after update
+        self.version = 0 # running frame number
+        self.jpeg = None
+        self.jpeg_version = 0
+        self.pending = None # encoding in progress
+        self.pending_version = 0
+        self.subscribers = set() # asyncio.Events
+        self.closed = False
+
+
+    def update(self, frame):
+        """Set the latest frame.  The source takes the ownership of frame: don't modify it afterwards
+        """
+        self.frame = frame
+        self.version += 1
+        for event in self.subscribers:
+            event.set()
+
+
+    def subscribe(self):
+        event = asyncio.Event()
+        self.subscribers.add(event)
+        if self.frame is not None:
+            event.set() # start with the latest frame
+        return event
+
+
+    def unsubscribe(self, event):
+        self.subscribers.discard(event)
+
+
+    def close(self):
+        """Wake up all subscribers: they should check closed
+        """
+        self.closed = True
+        for event in self.subscribers:
+            event.set()
+
+
+    async def getJPEG(self):
+        """Returns (frame number, JPEG of the latest frame) or (0, None) if there are no frames yet
+        """
+        if self.frame is None:
+            return 0, None
+        version = self.version
+        if self.jpeg_version == version:
+            return version, self.jpeg
+        if self.pending is None or self.pending_version != version:
+            self.pending = asyncio.get_event_loop().run_in_executor(
+                self.executor, encodeJPEG, self.frame, self.quality)
+            self.pending_version = version
+        pending = self.pending
+        jpeg = await asyncio.shield(pending)
+        if version > self.jpeg_version:
+            self.jpeg, self.jpeg_version = jpeg, version
+        return version, jpeg
@@ -80,7 +80,8 @@ class MasterProcess(MessageProcess):
         # here you would use your heavy neural net detector instance
         # and create a message with, for example, the bounding box coordinates
         obj = {
-            "this is" : "a message"
+            "this is" : "a message",
+            "mstimestamp" : meta.mstimestamp # of the analyzed frame: for frame-aligned overlays (emsg)
         }
         # send a message to the correct client:
         server.pushObject(obj)
@@ -188,7 +189,7 @@ class MasterProcess(MessageProcess):
             return
 
         ipc_index = client_process.getRGB24ServerPars()["ipc_index"]
-        data_ipc_index = client_process.data_ipc_index
+        data_ipc_index = client_process.dataclient_ipc_index
 
         with SyncIndex(self.eg) as sync_index: # wait until backend has finished
             self.sendMessageToBack(MessageObject(
@@ -0,0 +1,51 @@
+"""Server-side composition of several cameras into a single image
+"""
+import math
+import numpy as np
+
+
+class Mosaic:
+    """A preallocated RGB24 canvas of columns x rows tiles
+
+    Each tile is a view into the canvas, so rgb frames (of the tile size) are written
+    in-place, directly from shmem.  Tiles are numbered row by row:
+
+    ::
+
+        0 1 2
+        3 4 5
+
+    :param n_tiles: number of tiles
+    :param columns: tiles per row
+    :param tile_width: tile width in pixels
+    :param tile_height: tile height in pixels
+    """
+    def __init__(self, n_tiles, columns, tile_width, tile_height):
+        assert(n_tiles > 0 and columns > 0), "mosaic needs at least one tile & column"
+        self.columns = columns
+        self.rows = math.ceil(n_tiles / columns)
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.canvas = np.zeros((self.rows * tile_height, columns * tile_width, 3), dtype = np.uint8)
+        self.tiles = []
+        for i in range(n_tiles):
+            row, column = divmod(i, columns)
+            self.tiles.append(self.canvas[
+                row * tile_height : (row + 1) * tile_height,
+                column * tile_width : (column + 1) * tile_width
+            ])
+        self.dirty = False # written since the last snapshot
+
+
+    def write(self, i, frame):
+        """Copy an rgb frame of shape (tile_height, tile_width, 3) into tile i
+        """
+        np.copyto(self.tiles[i], frame)
+        self.dirty = True
+
+
+    def snapshot(self):
+        """Returns a copy of the canvas
+        """
+        self.dirty = False
+        return self.canvas.copy()
@@ -1,11 +1,21 @@
-import time, sys, asyncio, copy, logging, os, fcntl, errno, json, logging
+import time, sys, asyncio, copy, logging, os, fcntl, errno, json, logging, functools
+import urllib.parse
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 import websockets, traceback
 from multiprocessing import Event
 from valkka.multiprocess import MessageProcess, AsyncBackMessageProcess,\
     MessageObject, safe_select, EventGroup, SyncIndex
-from valkka.api2 import FragMP4ShmemClient, ShmemClient
+from valkka.api2 import FragMP4ShmemClient, ShmemClient, ShmemRGBClient
 from valkka.streamer.singleton import event_fd_group_1
+from valkka.streamer.multiprocess.fanout import FragRing, FMP4Viewer, KeyframeViewer, MessageChannel, \
+    EmsgInjector
+from valkka.streamer.multiprocess import mux, codec
+from valkka.streamer.multiprocess.bandwidth import Bandwidth
+from valkka.streamer.multiprocess.jpeg import JPEGSource
+from valkka.streamer.multiprocess.mosaic import Mosaic
+from valkka.streamer.multiprocess.wsprotocol import StreamerServerProtocol, extensionsByEndpoint
 
 from task_thread import TaskThread, reCreate, reSchedule,\
     delete, verbose, signals # https://elsampsa.github.io/task_thread/_build/html/index.html
@@ -25,10 +35,38 @@ class MultiServerProcess(AsyncBackMessageProcess):
 
     - Listens to intercom shmem channels for results
     - Listens to fragmp4 shmem channels for stream
+
+    :param mstimeout: shmem client semaphore timeout
+    :param stats_interval: interval in seconds for logging performance counters.  0 = no logging
+    :param gop_cache_size: max. bytes of fmp4 packets cached per camera, so that new websocket
+                           subscribers can start immediately from the latest keyframe.  0 = no caching
+    :param max_lag: max. bytes a websocket subscriber can lag behind before it is skipped forward
+                    to the latest keyframe.  0 = two GOPs of the camera (see fanout.Subscriber)
+    :param name: multiprocess name.  When running several MultiServerProcess shards, give each
+                 one a unique name
+    :param compression: websocket compression per endpoint, i.e. a dict with keys "stream", "message", etc.
+                        See wsprotocol.deflateFactory for the values.  None = use the defaults
+    :param drain: if True, all pending shmem ringbuffer entries are pulled per eventfd trigger
+                  with zero semaphore timeout (mstimeout is not used), so that the asyncio
+                  event loop is never blocked
+    :param replay_size: number of results kept per uuid, so that a reconnecting websocket client
+                        can resume with /ws/message/uuid?seq=N.  0 = no replay
+    :param bandwidth: egress caps for stream viewers (see bandwidth.Bandwidth).  None = no caps
+    :param jpeg_threads: number of worker threads for JPEG encoding of snapshots
     """
-    def __init__(self, mstimeout = 1000):
-        super().__init__()
+    def __init__(self, mstimeout = 1000, stats_interval = 10, gop_cache_size = 1024*1024*8, max_lag = 0,
+            name = "multiserver", compression = None, drain = True, replay_size = 100, bandwidth = None,
+            jpeg_threads = 2):
+        super().__init__(name = name)
+        self.jpeg_threads = jpeg_threads
+        self.replay_size = replay_size
+        self.bandwidth = Bandwidth(bandwidth)
+        self.compression = compression or {}
+        self.drain = drain
         self.mstimeout = mstimeout
+        self.stats_interval = stats_interval
+        self.gop_cache_size = gop_cache_size
+        self.max_lag = max_lag
         # self.logger = logging.getLogger("multiserver")
         self.rgb_register_lock = asyncio.Lock()
         """Multiprocessing clients are indexed by file descriptor (fd)
@@ -37,15 +75,20 @@ class MultiServerProcess(AsyncBackMessageProcess):
         self.intercom_client_by_fd = {} 
         self.fmp4_client_by_fd = {}
 
-        """Asyncio queues where stuff is being fed are also indexed
-        by file dtor (fd) indices:
+        """Messages from rgb processes are fanned out to all subscribers (each
+        with its own queue).  Also indexed by file dtor (fd) indices:
+        """
+        self.intercom_channel_by_fd = {}
+
+        """Frag-mp4 packets are written once into a ringbuffer per camera
+        that is shared by all websocket subscribers of that camera:
         """
-        self.intercom_queue_by_fd = {}
-        self.fmp4_queue_by_fd = {}        
+        self.fmp4_ring_by_fd = {}
 
         """Cache frag-mp4 metadata packets
         """
-        self.fmp4_meta_by_fd = {} # list of ftyp & moov
+        self.fmp4_meta_by_fd = {} # dict of ftyp & moov packets
+        self.fmp4_slot_by_fd = {} # filterchain slot: tags fmp4-start & fmp4-stop messages
 
         """Websockets are requested as per stream slot, so we
         beed these mappings:
@@ -53,15 +96,46 @@ class MultiServerProcess(AsyncBackMessageProcess):
         self.fmp4_fd_by_camname = {}
         self.intercom_fd_by_uuid = {}
 
+        """Decoded rgb frames for HTTP snapshots ("taps"): the latest frame per camera
+        is kept & JPEG-encoded on demand.  Clients indexed by fd, sources by camera name:
+        """
+        self.tap_client_by_fd = {}
+        self.tap_name_by_fd = {}
+        self.jpeg_source_by_name = {}
+        self.jpeg_executor = None
+
+        """Mosaics: taps that write into a tile of a mosaic instead (fd => (mosaic name, tile index)).
+        A mosaic is served like a camera, i.e. under its name in jpeg_source_by_name
+        """
+        self.tap_tile_by_fd = {}
+        self.mosaic_by_name = {}
+        self.mosaic_task_by_name = {}
+
         """Tasks that read from shmem servers and place packets into asyncio queues
         these are evoked upon websocket requests
         """
-        self.fmp4_task_by_fd = {} # corresponds to self.pushTask__ tasks
+        self.fmp4_tasks_by_fd = {} # corresponds to self.pushTask__ tasks: a set of tasks per fd
         self.intercom_task_by_fd = {} # corresponds to self.intercom__ tasks
+        self.mux_tasks = set() # corresponds to self.muxTask__ tasks
+        self.jpeg_tasks = set() # corresponds to self.jpegTask__ tasks
 
         self.ws_server = None
+        self.stats_task = None
+        self.loop_lag_task = None
+        self.n_ringbuffer_by_fd = {} # max. number of entries to drain per eventfd trigger
         self.slot_and_ipc_index_by_name = {} # only for frontend use
 
+        """Performance counters (backend)
+        """
+        self.copy_bytes = 0 # bytes copied from shmem
+        self.copy_count = 0 # number of fmp4 packets copied from shmem
+        self.wakeup_count = 0 # number of eventfd triggers
+        self.pull_count = 0 # number of shmem ringbuffer entries pulled
+        self.skip_count = 0 # .. of which released without copying, since nobody was listening
+        self.loop_lag_sum = 0 # event loop lag
+        self.loop_lag_count = 0
+        self.loop_lag_max = 0
+
         """Sync primitives for front/backend intercom sync
         """
         self.event_group = EventGroup(20, Event) # create 10 multiprocessing.Event instances
@@ -86,7 +160,10 @@ class MultiServerProcess(AsyncBackMessageProcess):
         loop = asyncio.get_event_loop()
         loop.remove_reader(fd)
         self.intercom_client_by_fd.pop(fd)
-        self.intercom_queue_by_fd.pop(fd)
+        channel = self.intercom_channel_by_fd.pop(fd)
+        for subscriber in channel.subscribers:
+            subscriber.event.set() # mux subscribers notice that the channel is gone
+        self.n_ringbuffer_by_fd.pop(fd, None)
         uuid = None
         for uuid, fd_value in self.intercom_fd_by_uuid.items():
             if fd_value == fd:
@@ -97,16 +174,21 @@ class MultiServerProcess(AsyncBackMessageProcess):
     @verbose
     async def clearFMP4ClientByFd__(self, fd):
         try:
-            task = self.fmp4_task_by_fd.pop(fd)
+            tasks = self.fmp4_tasks_by_fd.pop(fd)
         except KeyError:
             pass
         else:
-            await delete(task)
+            for task in list(tasks):
+                await delete(task)
         loop = asyncio.get_event_loop()
         loop.remove_reader(fd)
         self.fmp4_client_by_fd.pop(fd)
-        self.fmp4_queue_by_fd.pop(fd)
+        ring = self.fmp4_ring_by_fd.pop(fd)
+        for subscriber in ring.subscribers:
+            subscriber.event.set() # mux subscribers notice that the ring is gone
         self.fmp4_meta_by_fd.pop(fd)
+        self.fmp4_slot_by_fd.pop(fd, None)
+        self.n_ringbuffer_by_fd.pop(fd, None)
         camname = None
         for camname, fd_value in self.fmp4_fd_by_camname.items():
             if fd_value == fd:
@@ -114,10 +196,26 @@ class MultiServerProcess(AsyncBackMessageProcess):
         if camname is not None:
             self.fmp4_fd_by_camname.pop(camname)
 
+    def clearTapClientByFd__(self, fd):
+        loop = asyncio.get_event_loop()
+        loop.remove_reader(fd)
+        self.tap_client_by_fd.pop(fd)
+        self.n_ringbuffer_by_fd.pop(fd, None)
+        if self.tap_tile_by_fd.pop(fd, None) is not None:
+            return # the mosaic keeps the last frame in the tile
+        name = self.tap_name_by_fd.pop(fd)
+        source = self.jpeg_source_by_name.pop(name, None)
+        if source is not None:
+            source.close() # jpeg stream viewers exit
+
     async def asyncPre__(self):
         # print("asyncPre__")
         self.intercom_lock = asyncio.Lock()
         self.stream_lock = asyncio.Lock()
+        self.jpeg_executor = ThreadPoolExecutor(max_workers = self.jpeg_threads)
+        if self.stats_interval > 0:
+            self.stats_task = await taskify(self.statsTask__)
+            self.loop_lag_task = await taskify(self.loopLagTask__)
 
 
     async def asyncPost__(self):
@@ -131,22 +229,101 @@ class MultiServerProcess(AsyncBackMessageProcess):
         """
         if self.ws_server is not None:
             self.ws_server.close()
+
+        if self.stats_task is not None:
+            await delete(self.stats_task)
+        if self.loop_lag_task is not None:
+            await delete(self.loop_lag_task)
             
+        for task in list(self.mux_tasks):
+            await delete(task)
+
+        for task in list(self.jpeg_tasks):
+            await delete(task)
+
+        for task in list(self.mosaic_task_by_name.values()):
+            await delete(task)
+
         for fd in list(self.intercom_client_by_fd.keys()):
             await self.clearIntercomClientByFd__(fd)
 
         for fd in list(self.fmp4_client_by_fd.keys()):
             await self.clearFMP4ClientByFd__(fd)
+
+        for fd in list(self.tap_client_by_fd.keys()):
+            self.clearTapClientByFd__(fd)
+
+        if self.jpeg_executor is not None:
+            self.jpeg_executor.shutdown(wait = False)
     
 
+    async def loopLagTask__(self, interval = 0.1):
+        """Measure how late the asyncio event loop wakes us up, i.e. the event loop lag
+
+        Any blocking call in the event loop (say, a shmem client waiting for its semaphore)
+        shows up here
+        """
+        try:
+            while True:
+                t0 = time.monotonic()
+                await asyncio.sleep(interval)
+                lag = time.monotonic() - t0 - interval
+                self.loop_lag_sum += lag
+                self.loop_lag_count += 1
+                self.loop_lag_max = max(self.loop_lag_max, lag)
+        except asyncio.CancelledError:
+            self.logger.debug("loopLagTask__: cancelled")
+
+
+    async def statsTask__(self):
+        """Log performance counters every stats_interval seconds
+        """
+        try:
+            while True:
+                t0 = time.time()
+                copy_bytes, copy_count = self.copy_bytes, self.copy_count
+                wakeup_count, pull_count, skip_count = self.wakeup_count, self.pull_count, self.skip_count
+                await asyncio.sleep(self.stats_interval)
+                dt = time.time() - t0
+                self.logger.info("statsTask__: copied from shmem %.2f MB/s, %.1f packets/s",
+                    (self.copy_bytes - copy_bytes) / dt / 1024 / 1024,
+                    (self.copy_count - copy_count) / dt)
+                wakeups = self.wakeup_count - wakeup_count
+                self.logger.info("statsTask__: %.1f eventfd wakeups/s, %.2f entries pulled per wakeup, %.1f entries/s skipped (no subscribers)",
+                    wakeups / dt, (self.pull_count - pull_count) / max(wakeups, 1),
+                    (self.skip_count - skip_count) / dt)
+                self.logger.info("statsTask__: event loop lag mean %.1f ms, max %.1f ms",
+                    1000 * self.loop_lag_sum / max(self.loop_lag_count, 1),
+                    1000 * self.loop_lag_max)
+                self.loop_lag_sum, self.loop_lag_count, self.loop_lag_max = 0, 0, 0
+                self.logger.info("statsTask__: websocket egress: streams %.2f Mbit/s, messages %.2f Mbit/s",
+                    self.bandwidth.mbps("stream"), self.bandwidth.mbps("message"))
+                for websocket, mbps, total, buffered in self.bandwidth.connections():
+                    self.logger.debug("statsTask__: connection %s: %.2f Mbit/s, %s bytes sent, %s bytes in write buffer",
+                        websocket.remote_address, mbps, total, buffered)
+                for camname, fd in self.fmp4_fd_by_camname.items():
+                    for subscriber in self.fmp4_ring_by_fd[fd].subscribers:
+                        self.logger.debug("statsTask__: %s: subscriber %s lag %s packets / %s bytes, dropped %s packets in %s skips",
+                            camname, subscriber.name, subscriber.lag(), subscriber.lagBytes(),
+                            subscriber.drops, subscriber.skips)
+        except asyncio.CancelledError:
+            self.logger.debug("statsTask__: cancelled")
+
+
     ## ** all calls that have their origin in websocket request **
 
     @verbose
     async def clientRequest__(self, *args):
         """This happens when a new websocket is requested
 
-        Only one websocket connection per stream is allowed.  If there is a new incoming
-        connection to the same slot, then the connection is "stealed"
+        Any number of websocket connections per stream is allowed: they all read
+        from the same shared ringbuffer (see FragRing).
+
+        Only one websocket connection per message channel is allowed.  If there is a new incoming
+        connection to the same uuid, then the connection is "stealed"
+
+        Any number of streams and message channels can be multiplexed into a single
+        websocket at /ws/mux (see mux.py)
 
         The ws server drops connection when you exit this cofunction
         """
@@ -167,15 +344,33 @@ class MultiServerProcess(AsyncBackMessageProcess):
             ::
 
                 /ws/stream/camname = request stream for camera name camname
+                /ws/stream/camname?mode=key&fps=1 = .. only keyframes, max. 1 per second
+                /ws/stream/camname?emsg=1 = .. with the results of uuid camname embedded as emsg boxes
                 /ws/message/uuid = request message channel for roi with uuid
+                /ws/message/uuid?seq=N = .. resuming after sequence number N
+                /ws/jpeg/camname = JPEG stream (one binary message per frame) for camera name camname
+                /ws/jpeg/camname?fps=2 = .. max. 2 frames per second
 
             """
             self.logger.info("clientRequest__: websocket requested :")
             self.logger.info("clientRequest__: websocket path      :%s", path)
 
+            path, _, query = path.partition("?")
+            # query parameters, say ?seq=123 --> {"seq": "123"}
+            params = {key : values[-1] for key, values in urllib.parse.parse_qs(query).items()}
             parts = path.split("/")
-            self.logger.debug("clientRequest__: parts %s", parts) 
+            self.logger.debug("clientRequest__: parts %s, params %s", parts, params)
             # ['', 'ws', 'stream', '1']
+            if len(parts) >= 3 and parts[2] == "mux":
+                # /ws/mux or /ws/mux/shard
+                task = await taskify(self.muxTask__, websocket)
+                self.mux_tasks.add(task)
+                try:
+                    await asyncio.wait_for(task, None)
+                finally:
+                    self.mux_tasks.discard(task)
+                return
+
             if len(parts) != 4:
                 self.logger.warning("clientRequest__: invalid path: must have length of 4")
                 return
@@ -196,7 +391,12 @@ class MultiServerProcess(AsyncBackMessageProcess):
                 else:
                     self.logger.warning("clientRequest__ : dropping old ws connection for uuid %s", uuid)
                     await delete(task)
-                task = await taskify(self.intercom__, uuid, fd, websocket)
+                try:
+                    from_seq = int(params["seq"]) if "seq" in params else None
+                except ValueError:
+                    self.logger.warning("clientRequest__ : invalid seq %s", params["seq"])
+                    from_seq = None
+                task = await taskify(self.intercom__, uuid, fd, websocket, from_seq = from_seq)
                 self.intercom_task_by_fd[fd] = task
                 # .. task is now in "the ether" running independently.  Exit this routine once the task is cancelled (that closes the ws connection)
                 await asyncio.wait_for(task, None)
@@ -209,17 +409,33 @@ class MultiServerProcess(AsyncBackMessageProcess):
                 except KeyError:
                     self.logger.critical("clientRequest__ : camera name '%s' not active or found", camname)
                     return
-                try:
-                    task = self.fmp4_task_by_fd.pop(fd)
-                except KeyError:
-                    pass
-                else:
-                    self.logger.warning("clientRequest__ : dropping old ws connection for camname %s", camname)
-                    await delete(task)
-                task = await taskify(self.pushTask__, camname, fd, websocket)
-                self.fmp4_task_by_fd[fd] = task
+                task = await taskify(self.pushTask__, camname, fd, websocket,
+                    emsg = params.get("emsg") in ["1", "true"], **self.streamOptions__(params))
+                tasks = self.fmp4_tasks_by_fd.setdefault(fd, set())
+                tasks.add(task)
                 # .. task is now in "the ether" running independently.  Exit this routine once the task is cancelled (that closes the ws connection)
-                await asyncio.wait_for(task, None)
+                try:
+                    await asyncio.wait_for(task, None)
+                finally:
+                    tasks.discard(task)
+
+            elif parts[2] == "jpeg":
+                camname = tail
+                if camname not in self.jpeg_source_by_name:
+                    self.logger.critical("clientRequest__ : no JPEG stream for camera name '%s'", camname)
+                    return
+                try:
+                    fps = float(params["fps"]) if "fps" in params else None
+                    assert(fps is None or fps > 0)
+                except (ValueError, AssertionError):
+                    self.logger.warning("clientRequest__ : invalid fps %s", params["fps"])
+                    fps = None
+                task = await taskify(self.jpegTask__, camname, websocket, fps = fps)
+                self.jpeg_tasks.add(task)
+                try:
+                    await asyncio.wait_for(task, None)
+                finally:
+                    self.jpeg_tasks.discard(task)
 
         except Exception as e:
             self.logger.critical("clientRequest__ failed with: %s", e)
@@ -227,29 +443,30 @@ class MultiServerProcess(AsyncBackMessageProcess):
             raise(BaseException)
 
 
-    async def intercom__(self, uuid, fd, websocket):
-        """read messages from the intercom queue & forward them to the correct websocket
-        """
-        queue = self.intercom_queue_by_fd[fd]
+    async def intercom__(self, uuid, fd, websocket, from_seq = None):
+        """read messages from the intercom channel & forward them to the correct websocket
 
-        # purge queue from old messages
-        while not queue.empty():
-            queue.get_nowait()
+        :param from_seq: resume after this sequence number (replaying missed messages)
+        """
+        channel = self.intercom_channel_by_fd[fd]
+        # a new subscriber starts with an empty queue (or with the replayed messages)
+        subscriber = channel.subscribe(name = str(websocket.remote_address), from_seq = from_seq)
 
         ok = True
         try:
             while ok:
                 try:
                     # print("intercom__ : waiting message for uuid", uuid)
-                    json_str = await queue.get()
+                    message = await subscriber.get()
                     # print("intercom__ : got message for uuid", uuid)
                 except Exception as e:
                     self.logger.warning("intercom__ : getting packets failed with %s", e)
                     ok = False
 
                 try:
-                    json_bytes = json.dumps(json_str)
-                    await websocket.send(json_bytes)
+                    # json text by default or binary, as per negotiated subprotocol
+                    for payload in message.encode(websocket.subprotocol):
+                        await self.send__(websocket, "message", payload)
                     # self.logger.debug("intercom__ : sent message %s", json_str) # this may contain an image as a string!
                     self.logger.debug("intercom__ : sent message")
                 except Exception as e:
@@ -257,6 +474,9 @@ class MultiServerProcess(AsyncBackMessageProcess):
                     ok = False
         except asyncio.CancelledError:
             self.logger.info("intercom__ : cancelling for %s", uuid)
+        finally:
+            channel.unsubscribe(subscriber)
+            self.bandwidth.forget(websocket)
 
         try:
             await websocket.close()
@@ -266,98 +486,164 @@ class MultiServerProcess(AsyncBackMessageProcess):
         self.logger.info("intercom__ : exit")
 
 
+    def streamOptions__(self, params):
+        """Stream viewer options from websocket query parameters, i.e. mode & fps
+        """
+        options = {}
+        if params.get("mode") == "key":
+            options["mode"] = "key"
+            try:
+                options["fps"] = float(params.get("fps", 1))
+                assert(options["fps"] > 0)
+            except (ValueError, AssertionError):
+                self.logger.warning("streamOptions__ : invalid fps %s", params.get("fps"))
+                options["fps"] = 1
+        elif params.get("mode") is not None:
+            self.logger.warning("streamOptions__ : unknown mode %s", params.get("mode"))
+        return options
+
+
+    async def subscribeFMP4__(self, camname, fd, event = None, name = None, mode = None, fps = None):
+        """Subscribe a new viewer into the fmp4 ringbuffer of a camera
+
+        Tells the main process about the new viewer: the main process keeps count of the viewers
+        & activates the fmp4 shmem channel when needed
+
+        :param event: see FragRing.subscribe
+        :param mode: None = all frames, "key" = only keyframes (see KeyframeViewer)
+        :param fps: max. keyframes per second for mode "key"
+
+        Returns an FMP4Viewer or None if the viewer was rejected (see bandwidth.Bandwidth)
+        """
+        ring = self.fmp4_ring_by_fd[fd]
+        metadata = self.fmp4_meta_by_fd[fd]
+        admit = self.bandwidth.admit(ring.numSubscribers(), thinned = (mode == "key"))
+        if admit == "reject":
+            self.logger.warning("subscribeFMP4__: camname=%s: viewer %s rejected: over bandwidth caps",
+                camname, name)
+            return None
+        elif admit == "thin":
+            self.logger.warning("subscribeFMP4__: camname=%s: viewer %s thinned: over bandwidth caps",
+                camname, name)
+            mode, fps = "key", self.bandwidth.thin_fps
+        # start from the cached GOP (if any) for an instant start
+        subscriber = ring.subscribe(
+            event = event,
+            from_key = (self.gop_cache_size > 0),
+            max_lag = self.max_lag if self.max_lag > 0 else None,
+            name = name
+        )
+        self.logger.info("subscribeFMP4__: camname=%s has now %s subscriber(s), %s cached packets",
+            camname, ring.numSubscribers(), subscriber.lag())
+        # tell main process that there's a new viewer
+        # (meta = True makes the muxer to resend ftyp & moov)
+        await self.send_out__(MessageObject(
+            "fmp4-start",
+            camname = camname,
+            slot = self.fmp4_slot_by_fd[fd],
+            meta = (len(metadata) < 2)
+            ))
+        if mode == "key":
+            return KeyframeViewer(subscriber, metadata, fps = fps or 1)
+        return FMP4Viewer(subscriber, metadata)
+
+
+    async def unsubscribeFMP4__(self, camname, viewer):
+        """Remove a viewer from the fmp4 ringbuffer of a camera
+
+        Tells the main process that a viewer is gone: the main process deactivates the fmp4 shmem
+        channel after the last viewer (& a linger time).  Meanwhile, the ringbuffer is kept up-to-date,
+        so that a reconnecting viewer starts instantly from the cached GOP.  See c__fmp4Idle
+
+        fmp4-start & fmp4-stop are tagged with the filterchain slot, so that the main process can ignore
+        messages of a camera that has since been removed & re-added
+        """
+        subscriber = viewer.subscriber
+        ring = subscriber.ring
+        ring.unsubscribe(subscriber)
+        self.logger.info("unsubscribeFMP4__ : camname=%s subscriber %s dropped %s packets in %s skips",
+            camname, subscriber.name, subscriber.drops, subscriber.skips)
+        if ring.numSubscribers() < 1 and self.gop_cache_size < 1:
+            ring.clear()
+        fd = self.fmp4_fd_by_camname.get(camname)
+        if self.fmp4_ring_by_fd.get(fd) is ring:
+            # tell main process that a viewer is gone
+            await self.send_out__(MessageObject(
+                "fmp4-stop",
+                camname = camname,
+                slot = self.fmp4_slot_by_fd[fd]
+                ))
+
+
+    async def send__(self, websocket, kind, payload):
+        """websocket.send with egress accounting
+
+        :param kind: "stream" or "message"
+        :param payload: str, bytes or a tuple of bytes (a fragmented message)
+        """
+        await websocket.send(payload)
+        if isinstance(payload, tuple):
+            nbytes = sum(len(part) for part in payload)
+        else:
+            nbytes = len(payload)
+        self.bandwidth.count(websocket, kind, nbytes)
+
+
     @verbose
-    async def pushTask__(self, camname, fd, websocket):
-        """Starts a loop that reads fmp4 packets from a queue and
+    async def pushTask__(self, camname, fd, websocket, mode = None, fps = None, emsg = False):
+        """Starts a loop that reads fmp4 packets from the shared ringbuffer and
         pushes them through the websocket
+
+        :param emsg: embed the results of uuid camname into the stream (see EmsgInjector)
         """
         self.logger.info("pushTask_: starting FMP4 from camname=%s, fd=%s", camname, fd)
         # dumptest = True
         dumptest = False
-        # tell main process to activate the fmp4 shmem channel
-        await self.send_out__(MessageObject(
-            "fmp4-start",
-            camname = camname
-            ))
-
+        viewer = await self.subscribeFMP4__(camname, fd, name = str(websocket.remote_address),
+            mode = mode, fps = fps)
+        if viewer is None:
+            await websocket.close(1013, "over capacity, try again later")
+            return
+        subscriber = viewer.subscriber
+        injector = None
+        if emsg:
+            try:
+                channel = self.intercom_channel_by_fd[self.intercom_fd_by_uuid[camname]]
+            except KeyError:
+                self.logger.warning("pushTask__: no results for %s: emsg disabled", camname)
+            else:
+                injector = EmsgInjector(channel.subscribe(name = str(websocket.remote_address)))
         try:
-            key = False
-            ftyp = None
-            moov = None
-            init_ = False
             ok = True
+            drops = 0
 
             self.logger.info("pushTask_: receiving FMP4 from camname=%s, fd=%s", camname, fd)
             if dumptest:
                 f = open("dump.mp4", "wb", buffering = 0)
             while ok:
                 try:
-                    meta, packet = await self.fmp4_queue_by_fd[fd].get()
+                    meta, packet = await subscriber.get()
                     if dumptest:
                         self.logger.info("<%s> first=%s, len=%s, bytes=%s", 
                             meta.name, meta.is_first, meta.size, packet[0:5])
-                    """
-                    if meta.name == "moof":
-                        print(">THIS IS MOOF")
-                    else:
-                        print(">NOT MOOF", len(meta.name), meta.name)
-                    """
-
                 except Exception as e:
                     print("getting packets failed with", e)
                     ok = False
+                    break
 
-                if meta.name == "ftyp":
-                    init_ = False
-                    moov = None
-                    key = False
-                    self.logger.info("pushTask_: got ftyp for camname=%s, fd=%s", 
-                        camname, fd)
-                    if ftyp is None:
-                        ftyp = packet
-                    else:
-                        continue
-
-                if meta.name == "moov":
-                    key = False
-                    self.logger.info("pushTask_: got moov for camname=%s, fd=%s", 
-                        camname, fd)
-                    if moov is None:
-                        moov = packet
-                    else:
-                        continue
-
-                if meta.name == "moof":
-                    # print("moof.is_first", meta.is_first)
-                    if ( (not key) and (ftyp is not None) and (moov is not None) and meta.is_first ):
-                        # == keyframe not yet received, but ftyp & moov cached & just got moof keyframe
-                        key = True
-                        self.logger.info("pushTask_: got moof keyframe for camname=%s, fd=%s", 
-                            camname, fd)
-
-                if not key:
-                    # no keyframe received yet
-                    # print("got", meta.name)
-                    continue
-                else:
-                    # print("keyframe received", meta.name)
-                    pass
+                if subscriber.drops != drops:
+                    drops = subscriber.drops
+                    self.logger.info("pushTask_: camname=%s subscriber %s fell behind: %s packets dropped so far",
+                        camname, subscriber.name, drops)
 
                 try:
-                    if not init_:
-                        self.logger.info("pushTask__ : sending ftyp and moov")
-                        await websocket.send(ftyp.tobytes())
-                        await websocket.send(moov.tobytes())
+                    payloads = viewer.filter(meta, packet)
+                    if injector is not None:
+                        payloads = injector.inject(viewer, meta, payloads)
+                    for payload in payloads:
+                        await self.send__(websocket, "stream", payload)
                         if dumptest:
-                            f.write(ftyp.tobytes())
-                            f.write(moov.tobytes())
-                            # f.flush()
-                        init_ = True
-                    await websocket.send(packet.tobytes())
-                    if dumptest:
-                        f.write(packet.tobytes())
-                        # f.flush()
-                    # print("sent packet", meta.name, packet[0:10], "of length", packet.shape)
+                            f.write(payload)
                 except Exception as e:
                     self.logger.warning("pushTask__ : websocket send failed with %s", e)
                     ok = False
@@ -376,15 +662,212 @@ class MultiServerProcess(AsyncBackMessageProcess):
         except Exception as e:
             self.logger.warning("pushTask__ : could not close websocket for %s, reason: %s", camname, e)
 
-        # tell main process to deactivate the fmp4 shmem channel
-        await self.send_out__(MessageObject(
-            "fmp4-stop",
-            camname = camname
-            ))
-
+        await self.unsubscribeFMP4__(camname, viewer)
+        if injector is not None:
+            injector.subscriber.channel.unsubscribe(injector.subscriber)
+        self.bandwidth.forget(websocket)
         self.logger.info("pushTask__ : exit")
 
 
+    async def jpegTask__(self, camname, websocket, fps = None):
+        """Pushes the latest frame of a camera as JPEG through the websocket
+
+        Each frame is encoded once & shared by all viewers (see JPEGSource).  A slow viewer
+        just skips frames: it always gets the latest one once its previous send has finished
+
+        :param fps: max. frames per second for this viewer.  None = as they come from the tap
+        """
+        source = self.jpeg_source_by_name[camname]
+        event = source.subscribe()
+        self.logger.info("jpegTask__: starting JPEG stream of camname=%s", camname)
+        version = 0
+        t = 0
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                if source.closed:
+                    break
+                if fps is not None:
+                    dt = t + 1 / fps - time.monotonic()
+                    if dt > 0:
+                        await asyncio.sleep(dt)
+                new_version, jpeg = await source.getJPEG()
+                if jpeg is None or new_version <= version:
+                    continue
+                version = new_version
+                t = time.monotonic()
+                await self.send__(websocket, "stream", jpeg)
+        except asyncio.CancelledError:
+            self.logger.info("jpegTask__: cancelling for camname=%s", camname)
+        except Exception as e:
+            self.logger.warning("jpegTask__: camname=%s failed with %s", camname, e)
+        finally:
+            source.unsubscribe(event)
+            self.bandwidth.forget(websocket)
+        try:
+            await websocket.close()
+        except Exception as e:
+            self.logger.warning("jpegTask__: could not close websocket for %s, reason: %s", camname, e)
+        self.logger.info("jpegTask__: exit")
+
+
+    @verbose
+    async def muxTask__(self, websocket):
+        """Multiplexes any number of fmp4 streams & message channels into a single websocket
+
+        See mux.py for the wire format.  All subscriptions share a single asyncio.Event,
+        so one task serves the whole connection.  Each channel gets max. mux.BUDGET items per
+        round, message channels first: if anything is left, the event is set for another round
+        """
+        event = asyncio.Event()
+        name = str(websocket.remote_address)
+        channels = {} # channel number => (type, name, fd, FMP4Viewer or MessageSubscriber)
+        channel_by_key = {} # (type, name) => channel number
+        next_channel = 0
+
+        async def subscribe(type_, names, resume = {}, options = {}):
+            nonlocal next_channel
+            subscribed, missing, rejected = [], [], []
+            for name_ in names:
+                if (type_, name_) in channel_by_key:
+                    continue
+                if len(channels) >= mux.MAX_CHANNELS:
+                    self.logger.warning("muxTask__ : %s: too many channels", name)
+                    missing.append({"type" : mux.TYPE_NAMES[type_], "name" : name_})
+                    continue
+                if type_ == mux.STREAM:
+                    fd = self.fmp4_fd_by_camname.get(name_)
+                else:
+                    fd = self.intercom_fd_by_uuid.get(name_)
+                if fd is None:
+                    missing.append({"type" : mux.TYPE_NAMES[type_], "name" : name_})
+                    continue
+                while next_channel in channels:
+                    next_channel = (next_channel + 1) % mux.MAX_CHANNELS
+                if type_ == mux.STREAM:
+                    source = await self.subscribeFMP4__(name_, fd, event = event, name = name,
+                        **self.streamOptions__(options.get(name_, {})))
+                    if source is None:
+                        rejected.append({"type" : mux.TYPE_NAMES[type_], "name" : name_})
+                        continue
+                else:
+                    source = self.intercom_channel_by_fd[fd].subscribe(event = event, name = name,
+                        from_seq = resume.get(name_))
+                channels[next_channel] = (type_, name_, fd, source)
+                channel_by_key[(type_, name_)] = next_channel
+                subscribed.append({"channel" : next_channel, "type" : mux.TYPE_NAMES[type_], "name" : name_})
+            return subscribed, missing, rejected
+
+        async def unsubscribe(channel):
+            type_, name_, fd, source = channels.pop(channel)
+            channel_by_key.pop((type_, name_))
+            if type_ == mux.STREAM:
+                await self.unsubscribeFMP4__(name_, source)
+            else:
+                source.channel.unsubscribe(source)
+            return {"channel" : channel, "type" : mux.TYPE_NAMES[type_], "name" : name_}
+
+        def isGone(type_, fd, source):
+            # camera / uuid removed at the server
+            if type_ == mux.STREAM:
+                return self.fmp4_ring_by_fd.get(fd) is not source.subscriber.ring
+            return self.intercom_channel_by_fd.get(fd) is not source.channel
+
+        async def control():
+            # read (un)subscribe requests from the client
+            while True:
+                msg = await websocket.recv()
+                try:
+                    msg = json.loads(msg)
+                except ValueError:
+                    self.logger.warning("muxTask__ : %s: invalid control message", name)
+                    continue
+                response = {"subscribed" : [], "unsubscribed" : [], "missing" : [], "rejected" : []}
+                for type_ in [mux.STREAM, mux.MESSAGE]:
+                    key = mux.TYPE_NAMES[type_] + "s" # streams, messages
+                    subscribed, missing, rejected = await subscribe(type_, msg.get("subscribe", {}).get(key, []),
+                        resume = msg.get("resume", {}), options = msg.get("options", {}))
+                    response["subscribed"] += subscribed
+                    response["missing"] += missing
+                    response["rejected"] += rejected
+                    for name_ in msg.get("unsubscribe", {}).get(key, []):
+                        if (type_, name_) in channel_by_key:
+                            response["unsubscribed"].append(await unsubscribe(channel_by_key[(type_, name_)]))
+                await websocket.send(json.dumps(response))
+                event.set()
+
+        self.logger.info("muxTask__ : starting for %s", name)
+        control_task = await taskify(control)
+        try:
+            while not control_task.done():
+                event.clear()
+                gone = []
+                # round-robin: message channels (small & latency-sensitive) first
+                for channel, (type_, name_, fd, source) in sorted(channels.items(),
+                        key = lambda item: item[1][0] == mux.STREAM):
+                    if channel not in channels:
+                        continue # unsubscribed while we were sending
+                    if isGone(type_, fd, source):
+                        gone.append(channel)
+                        continue
+                    if type_ == mux.STREAM:
+                        for i in range(mux.BUDGET):
+                            item = source.subscriber.pull()
+                            if item is None:
+                                break
+                            for payload in source.filter(*item):
+                                await self.send__(websocket, "stream", mux.frame(mux.STREAM, channel, payload))
+                        else:
+                            event.set() # budget used up: continue in the next round
+                    else:
+                        for i in range(mux.BUDGET):
+                            message = source.pull()
+                            if message is None:
+                                break
+                            payloads = message.encode(websocket.subprotocol)
+                            await self.send__(websocket, "message",
+                                mux.frame(mux.MESSAGE, channel, mux.asBytes(payloads[0])))
+                            for payload in payloads[1:]:
+                                await self.send__(websocket, "message", mux.frame(mux.ATTACHMENT, channel, payload))
+                        else:
+                            event.set()
+                if len(gone) > 0:
+                    unsubscribed = [await unsubscribe(channel) for channel in gone]
+                    await websocket.send(json.dumps({"subscribed" : [], "unsubscribed" : unsubscribed,
+                        "missing" : [], "rejected" : []}))
+                if event.is_set():
+                    # new packets arrived while we were sending or something was left over:
+                    # let the shmem callbacks & other tasks run before the next round
+                    await asyncio.sleep(0)
+                    continue
+                waiter = asyncio.ensure_future(event.wait())
+                await asyncio.wait([control_task, waiter], return_when = asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+
+        except asyncio.CancelledError:
+            self.logger.info("muxTask__ : cancelling for %s", name)
+
+        except websockets.ConnectionClosed:
+            self.logger.info("muxTask__ : connection closed for %s", name)
+
+        except Exception as e:
+            self.logger.warning("muxTask__ : failed with %s", e)
+
+        if not control_task.done():
+            await delete(control_task)
+        elif not control_task.cancelled() and control_task.exception() is not None:
+            self.logger.info("muxTask__ : control for %s exited with %s", name, repr(control_task.exception()))
+        for channel in list(channels.keys()):
+            await unsubscribe(channel)
+        self.bandwidth.forget(websocket)
+        try:
+            await websocket.close()
+        except Exception as e:
+            self.logger.warning("muxTask__ : could not close websocket for %s, reason: %s", name, e)
+        self.logger.info("muxTask__ : exit")
+
+
     # *** calls initiated by the main python process ***
 
     ## callbacks that are registered into the asyncio event loop
@@ -399,56 +882,139 @@ class MultiServerProcess(AsyncBackMessageProcess):
         
         NOTE: this must be a non-blocking method
 
-        Each mp4 fragment is placed into an asyncio queue.
+        Each mp4 fragment is copied once into the shared ringbuffer of the camera.
+        The copy is an immutable bytes object that is passed as-is to websocket.send
+        for all subscribers.  If the camera has no subscribers, fragments are
+        released from shmem without copying (except for ftyp & moov), unless
+        GOP caching is enabled.
+
+        In drain mode, all pending fragments are pulled (with zero timeout)
         """
         # self.logger.debug("fragCallback: fd=%s", fd)
+        self.wakeup_count += 1
+        n = self.n_ringbuffer_by_fd[fd] if self.drain else 1
+        for i in range(n):
+            if not self.pullFrag__(fd):
+                break
+        # self.logger.debug("fragCallback: exit fd=%s", fd)
+
+
+    def pullFrag__(self, fd):
+        """Pull one fragment from the fmp4 shmem client into the ring
+
+        Returns False if there was nothing to pull
+        """
         dump_packets = False # enable for per-packet extreme verbosity
-        queue = self.fmp4_queue_by_fd[fd]
+        ring = self.fmp4_ring_by_fd[fd]
         client = self.fmp4_client_by_fd[fd]
         # self.logger.debug("fragCallback: fd=%s waiting for client", fd)
         index, meta = client.pullFrame()
         if dump_packets: print("fragCallback: fd=%s got packet" % (str(fd)))
         if (index == None):
             if dump_packets: print("fragCallback: frag-mp4 client timeout fd=%s" % (str(fd)))
+            return False
         else:
+            self.pull_count += 1
+            if ring.numSubscribers() < 1 and meta.name not in ["moov", "ftyp"] and self.gop_cache_size < 1:
+                # nobody's watching: the stream is about to be gated off anyway
+                self.skip_count += 1
+                return True
             data = client.shmem_list[index][0:meta.size]
             # self.logger.debug("fragCallback: data len=%s, data type=%s", data.size, meta.name)
+            payload = data.tobytes() # the one and only copy
+            self.copy_bytes += meta.size
+            self.copy_count += 1
             if meta.name in ["moov", "ftyp"]:
                 self.logger.debug("fragCallback: fd=%s, moov/ftyp data len=%s, data type=%s", fd, data.size, meta.name)
-            """ # no caching of moov & ftyp here
-                # self.logger.debug("fragCallback: 1")
-                metadata = self.fmp4_meta_by_fd[fd]
-                # self.logger.debug("fragCallback: 2")
-                if len(metadata) >= 2:
-                    pass
-                else:
-                    # self.logger.debug("fragCallback: 3")
-                    self.fmp4_meta_by_fd[fd].append(data)
-                self.logger.debug("fragCallback: number of metadata packets now=%s", len(self.fmp4_meta_by_fd[fd]))
-            else:
-            """
-            if queue.full(): # make space in the queue
-                # self.logger.warning("fmp4 queue overflow")
-                queue.get_nowait()
-            queue.put_nowait((
-                copy.copy(meta), data.copy() # (metadata, payload)
-                ))
-        # self.logger.debug("fragCallback: exit fd=%s", fd)
+                # cache latest metadata for new subscribers
+                self.fmp4_meta_by_fd[fd][meta.name] = payload
+            ring.push(
+                copy.copy(meta), payload, # (metadata, payload)
+                key = (meta.name == "moof" and meta.is_first)
+                )
+            return True
 
 
     def rgbCallback(self, fd):
         """This handles messages coming from an rgb process
+
+        In drain mode, all pending messages are pulled (with zero timeout)
+        """
+        self.wakeup_count += 1
+        if not self.drain:
+            self.pullObject__(fd)
+            return
+        for i in range(self.n_ringbuffer_by_fd[fd]):
+            if not self.pullObject__(fd, warn = False):
+                break
+
+
+    def tapCallback(self, fd):
+        """This handles rgb frames for snapshots & mosaic tiles
+
+        Only the latest frame is kept: in drain mode, all pending frames are pulled
+        & all but the last one are just released
+        """
+        self.wakeup_count += 1
+        client = self.tap_client_by_fd[fd]
+        frame = None
+        for i in range(self.n_ringbuffer_by_fd[fd] if self.drain else 1):
+            index, meta = client.pullFrame()
+            if index is None:
+                break
+            self.pull_count += 1
+            if frame is not None:
+                self.skip_count += 1
+            frame = (index, meta)
+        if frame is None:
+            return
+        index, meta = frame
+        data = client.shmem_list[index][0:meta.size].reshape((meta.height, meta.width, 3))
+        try:
+            name, tile = self.tap_tile_by_fd[fd]
+        except KeyError:
+            # copy: the shmem slot is overwritten while the encoder might still be using it
+            self.jpeg_source_by_name[self.tap_name_by_fd[fd]].update(data.copy())
+        else:
+            self.mosaic_by_name[name].write(tile, data)
+
+
+    def hasIntercomSubscribers__(self, fd):
+        """Is anyone listening to messages from intercom fd
+        """
+        return self.intercom_channel_by_fd[fd].numSubscribers() > 0
+
+
+    def pullObject__(self, fd, warn = True):
+        """Pull one message from an rgb process into the intercom queue
+
+        If nobody is listening, the message is not unpickled: it's either just released from
+        shmem or, if there's a replay ring, kept there in its pickled form
+
+        Returns False if there was nothing to pull
         """
         client = self.intercom_client_by_fd[fd]
+        if not self.hasIntercomSubscribers__(fd):
+            index, size = client.pull()
+            if index is None:
+                return False
+            self.pull_count += 1
+            channel = self.intercom_channel_by_fd[fd]
+            if channel.replay is not None:
+                channel.push(codec.Message(raw = client.shmem_list[index][0:size].tobytes()))
+            else:
+                self.skip_count += 1
+            return True
         obj = client.pullObject()
-        queue = self.intercom_queue_by_fd[fd]
         if (obj == None):
-            self.logger.warning("MultiServer: warning: no rgb data")
+            if warn:
+                self.logger.warning("MultiServer: warning: no rgb data")
+            return False
         else:
-            if queue.full(): # make space in the queue
-                # self.logger.debug("MultiServer: queue pop")
-                queue.get_nowait()
-            queue.put_nowait(obj)
+            self.pull_count += 1
+            # encoded only when sent, at most once per subprotocol
+            self.intercom_channel_by_fd[fd].push(codec.Message(obj))
+            return True
 
 
     # ** backend part of process calls **
@@ -456,8 +1022,14 @@ class MultiServerProcess(AsyncBackMessageProcess):
     async def c__startWServer(self, port = 3001):
         try:
             self.logger.info("c__startWServer: starting at port %s", port)
+            # permessage-deflate is negotiated per endpoint by StreamerServerProtocol
+            create_protocol = functools.partial(StreamerServerProtocol,
+                extensions_by_endpoint = extensionsByEndpoint(self.compression))
             # self.ws_server = await websockets.serve(self.clientRequest__, host = "localhost", port = port) # docker doesn't like localhost
-            self.ws_server = await websockets.serve(self.clientRequest__, host = "0.0.0.0", port = port)
+            self.ws_server = await websockets.serve(self.clientRequest__, host = "0.0.0.0", port = port,
+                create_protocol = create_protocol, compression = None,
+                subprotocols = codec.availableSubprotocols(),
+                process_request = self.processRequest__)
             # .. that is not a coroutine nor task, but just a method that encapsulates the related coroutines and tasks
             # print("coro", coro)
         except Exception as e:
@@ -485,7 +1057,7 @@ class MultiServerProcess(AsyncBackMessageProcess):
             name = name,
             n_ringbuffer = n_ringbuffer,
             n_size = n_size,
-            mstimeout = self.mstimeout
+            mstimeout = 0 if self.drain else self.mstimeout
         )
         self.logger.debug("c__registerFMP4Pars: slot=%s creating fmp4 client", slot)
         # _, eventfd = event_fd_group_1.reserve() # NOPES!
@@ -495,8 +1067,13 @@ class MultiServerProcess(AsyncBackMessageProcess):
         self.logger.debug("c__registerFMP4Pars: slot=%s using eventd %s", slot, fd)
 
         self.fmp4_client_by_fd[fd] = client
-        self.fmp4_queue_by_fd[fd] = asyncio.Queue(100)
-        self.fmp4_meta_by_fd[fd] = []
+        self.n_ringbuffer_by_fd[fd] = n_ringbuffer
+        self.fmp4_ring_by_fd[fd] = FragRing(
+            maxlen = 500, # grows up to gop_cache_size bytes
+            maxbytes = self.gop_cache_size if self.gop_cache_size > 0 else None
+        )
+        self.fmp4_meta_by_fd[fd] = {}
+        self.fmp4_slot_by_fd[fd] = slot
         self.fmp4_fd_by_camname[camname] = fd
         
         # schedule a re-scheduling task that pushes fmp4 to the websocket
@@ -513,7 +1090,7 @@ class MultiServerProcess(AsyncBackMessageProcess):
         ipc_index = None,
         sync_event_index = None
         ):
-        fd = fdFromIndex(ipc_index)
+        fd = event_fd_group_1.fromIndex(ipc_index).getFd()
         # TODO: close any active websockets
         # tell main process to deactivate mp4 channel
         await self.clearFMP4ClientByFd__(fd)
@@ -538,7 +1115,10 @@ class MultiServerProcess(AsyncBackMessageProcess):
         n_bytes = None,
         ipc_index = None,
         # slot = None, # not needed & confusing
-        sync_event_index = None
+        sync_event_index = None,
+        mode = "all",
+        max_rate = None,
+        delta = None
         ):
         async with self.rgb_register_lock:
             eventfd = event_fd_group_1.fromIndex(ipc_index)
@@ -550,11 +1130,18 @@ class MultiServerProcess(AsyncBackMessageProcess):
                 name = name,
                 n_ringbuffer = n_ringbuffer,
                 n_bytes = n_bytes,
-                mstimeout = self.mstimeout
+                mstimeout = 0 if self.drain else self.mstimeout
             )
             client.useEventFd(eventfd)
             self.intercom_client_by_fd[fd] = client
-            self.intercom_queue_by_fd[fd] = asyncio.Queue(100)
+            self.n_ringbuffer_by_fd[fd] = n_ringbuffer
+            try:
+                channel = MessageChannel(maxlen = 100, mode = mode, max_rate = max_rate, delta = delta,
+                    replay_size = self.replay_size)
+            except AssertionError as e:
+                self.logger.critical("c__registerRGBProcess: uuid %s: %s: using delivery mode all", uuid, e)
+                channel = MessageChannel(maxlen = 100, replay_size = self.replay_size)
+            self.intercom_channel_by_fd[fd] = channel
             
             self.intercom_fd_by_uuid[uuid] = fd
             self.logger.debug("c__registerRGBProcess: intecom_fd_by_uuid now %s", pformat(self.intercom_fd_by_uuid))
@@ -571,13 +1158,151 @@ class MultiServerProcess(AsyncBackMessageProcess):
         sync_event_index = None
         ):
         async with self.rgb_register_lock:
-            fd = fdFromIndex(ipc_index)
+            fd = event_fd_group_1.fromIndex(ipc_index).getFd()
             self.logger.info("c__deregisterRGBProcess: intercom fd=%s", fd)
             await self.clearIntercomClientByFd__(fd)
         self.event_group.fromIndex(sync_event_index).set()
 
 
 
+    async def processRequest__(self, path, request_headers):
+        """Plain HTTP requests, served before the websocket handshake:
+
+        ::
+
+            /snapshot/camname.jpg       JPEG of the latest frame of camera camname
+
+        Returns None for websocket requests
+        """
+        parts = path.split("?")[0].split("/")
+        if len(parts) != 3 or parts[1] != "snapshot":
+            return None
+        name = parts[2]
+        if not name.endswith(".jpg"):
+            return HTTPStatus.NOT_FOUND, [], b""
+        name = name[:-len(".jpg")]
+        try:
+            source = self.jpeg_source_by_name[name]
+        except KeyError:
+            self.logger.debug("processRequest__: no snapshots for %s", name)
+            return HTTPStatus.NOT_FOUND, [], b""
+        try:
+            version, jpeg = await source.getJPEG()
+        except Exception as e:
+            self.logger.warning("processRequest__: %s: JPEG encoding failed with %s", name, e)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, [], b""
+        if jpeg is None: # no frames yet
+            return HTTPStatus.SERVICE_UNAVAILABLE, [("Retry-After", "1")], b""
+        return HTTPStatus.OK, [
+            ("Content-Type", "image/jpeg"),
+            ("Cache-Control", "no-cache"),
+            ("X-Frame-Number", str(version))
+            ], jpeg
+
+
+    @verbose
+    async def c__registerRGBTap(self,
+        camname = None,
+        name = None,
+        n_ringbuffer = None,
+        width = None,
+        height = None,
+        ipc_index = None,
+        quality = 80,
+        mosaic = None,
+        tile = None,
+        sync_event_index = None
+        ):
+        """Listen to decoded rgb frames of a camera for snapshots
+
+        If mosaic is given, the frames are written into tile number tile of that mosaic instead
+        """
+        eventfd = event_fd_group_1.fromIndex(ipc_index)
+        fd = eventfd.getFd()
+        self.logger.debug("c__registerRGBTap: camname=%s, name=%s, fd=%s", camname, name, fd)
+        client = ShmemRGBClient(
+            name = name,
+            n_ringbuffer = n_ringbuffer,
+            width = width,
+            height = height,
+            mstimeout = 0 if self.drain else self.mstimeout,
+            verbose = False
+        )
+        client.useEventFd(eventfd)
+        self.tap_client_by_fd[fd] = client
+        self.n_ringbuffer_by_fd[fd] = n_ringbuffer
+        if mosaic is None:
+            self.tap_name_by_fd[fd] = camname
+            self.jpeg_source_by_name[camname] = JPEGSource(self.jpeg_executor, quality = quality)
+        else:
+            self.tap_tile_by_fd[fd] = (mosaic, tile)
+        loop = asyncio.get_event_loop()
+        loop.add_reader(fd, self.tapCallback, fd)
+        self.logger.info("c__registerRGBTap: camname=%s, mosaic=%s OK", camname, mosaic)
+        self.event_group.fromIndex(sync_event_index).set()
+
+
+    async def c__deregisterRGBTap(self,
+        ipc_index = None,
+        sync_event_index = None
+        ):
+        fd = event_fd_group_1.fromIndex(ipc_index).getFd()
+        try:
+            self.clearTapClientByFd__(fd)
+        except KeyError:
+            self.logger.warning("c__deregisterRGBTap: no tap at ipc_index %s", ipc_index)
+        self.event_group.fromIndex(sync_event_index).set()
+
+
+    async def c__registerMosaic(self,
+        name = None,
+        n_tiles = None,
+        columns = None,
+        tile_width = None,
+        tile_height = None,
+        fps = 1,
+        quality = 80,
+        sync_event_index = None
+        ):
+        """Create a mosaic, served like a camera at /snapshot/name.jpg & /ws/jpeg/name
+        """
+        mosaic = Mosaic(n_tiles, columns, tile_width, tile_height)
+        self.mosaic_by_name[name] = mosaic
+        self.jpeg_source_by_name[name] = JPEGSource(self.jpeg_executor, quality = quality)
+        self.mosaic_task_by_name[name] = await taskify(self.mosaicTask__, name, fps)
+        self.logger.info("c__registerMosaic: %s with %s tiles, %sx%s OK",
+            name, n_tiles, mosaic.canvas.shape[1], mosaic.canvas.shape[0])
+        self.event_group.fromIndex(sync_event_index).set()
+
+
+    async def mosaicTask__(self, name, fps):
+        """Publish the mosaic canvas fps times per second, if any tile has changed
+        """
+        mosaic = self.mosaic_by_name[name]
+        source = self.jpeg_source_by_name[name]
+        try:
+            while True:
+                await asyncio.sleep(1 / fps)
+                if mosaic.dirty:
+                    # copy: tiles keep on being written while the encoder uses the frame
+                    source.update(mosaic.snapshot())
+        except asyncio.CancelledError:
+            self.logger.debug("mosaicTask__: %s cancelled", name)
+
+
+    async def c__fmp4Idle(self, camname = None):
+        """Main process has deactivated the fmp4 shmem channel: the cached GOP is now stale
+        """
+        try:
+            fd = self.fmp4_fd_by_camname[camname]
+        except KeyError:
+            self.logger.warning("c__fmp4Idle: no such camera %s", camname)
+            return
+        ring = self.fmp4_ring_by_fd[fd]
+        self.logger.debug("c__fmp4Idle: camname=%s, subscribers=%s", camname, ring.numSubscribers())
+        ring.clear()
+
+
     # *** frontend ***
 
     def startWServer(self, port = 3001):
@@ -587,6 +1312,15 @@ class MultiServerProcess(AsyncBackMessageProcess):
         ))
 
 
+    def fmp4Idle(self, camname):
+        """Tell the backend that the fmp4 shmem channel of camera camname has been deactivated
+        """
+        self.sendMessageToBack(MessageObject(
+            "fmp4Idle",
+            camname = camname
+        ))
+
+
     # the following calls add and remove shmem clients
     # in the backend, so their completion must be waited 
     # in the frontend
@@ -632,7 +1366,14 @@ class MultiServerProcess(AsyncBackMessageProcess):
         self.logger.info("deregisterFMP4Pars name=%s OK", name)
 
 
-    def registerRGBProcess(self, rgb_process):
+    def registerRGBProcess(self, rgb_process, mode = "all", max_rate = None, delta = None):
+        """Listen to results from an rgb process
+
+        :param mode: delivery mode of the results to websockets: all, latest or rate
+                     (see fanout.MessageChannel)
+        :param max_rate: max. results per second for mode rate
+        :param delta: None or a dict of delta encoding parameters (see delta.DeltaEncoder)
+        """
         pars = rgb_process.getDataShmemPars()
 
         with SyncIndex(self.event_group) as i:
@@ -644,7 +1385,10 @@ class MultiServerProcess(AsyncBackMessageProcess):
                 ipc_index = pars["ipc_index"],
                 # slot = pars["slot"], # not needed & confusing
                 sync_event_index = i,
-                uuid = rgb_process.getUUID()
+                uuid = rgb_process.getUUID(),
+                mode = mode,
+                max_rate = max_rate,
+                delta = delta
             ))
         self.logger.info("registerRGBProcess OK")
 
@@ -659,6 +1403,62 @@ class MultiServerProcess(AsyncBackMessageProcess):
             ))
         self.logger.info("deregisterRGBProcess OK")
 
+
+    def registerRGBTap(self, camname, pars, quality = 80, mosaic = None, tile = None):
+        """Serve snapshots of camera camname from an rgb shmem server
+
+        :param pars: shmem parameters, as returned by RGB24Tap.getPars (see chain/tap.py)
+        :param quality: JPEG quality
+        :param mosaic: name of a mosaic (see registerMosaic): feed tile number tile of the mosaic
+                       instead.  The frame size must be the tile size
+        """
+        with SyncIndex(self.event_group) as i:
+            self.sendMessageToBack(MessageObject(
+                "registerRGBTap",
+                camname = camname,
+                name = pars["name"],
+                n_ringbuffer = pars["n_ringbuffer"],
+                width = pars["width"],
+                height = pars["height"],
+                ipc_index = pars["ipc_index"],
+                quality = quality,
+                mosaic = mosaic,
+                tile = tile,
+                sync_event_index = i
+            ))
+        self.logger.info("registerRGBTap %s OK", camname)
+
+
+    def registerMosaic(self, name, n_tiles, columns, tile_width, tile_height, fps = 1, quality = 80):
+        """Compose n_tiles rgb taps into a single image, served at /snapshot/name.jpg & /ws/jpeg/name
+
+        :param columns: tiles per row
+        :param fps: compositions per second
+        """
+        with SyncIndex(self.event_group) as i:
+            self.sendMessageToBack(MessageObject(
+                "registerMosaic",
+                name = name,
+                n_tiles = n_tiles,
+                columns = columns,
+                tile_width = tile_width,
+                tile_height = tile_height,
+                fps = fps,
+                quality = quality,
+                sync_event_index = i
+            ))
+        self.logger.info("registerMosaic %s OK", name)
+
+
+    def deregisterRGBTap(self, pars):
+        with SyncIndex(self.event_group) as i:
+            self.sendMessageToBack(MessageObject(
+                "deregisterRGBTap",
+                ipc_index = pars["ipc_index"],
+                sync_event_index = i
+            ))
+        self.logger.info("deregisterRGBTap OK")
+
     
 
 def test1():
@@ -0,0 +1,78 @@
+"""Wire format of the multiplexed websocket endpoint /ws/mux
+
+A single websocket carries fmp4 streams of many cameras & result messages of many uuids.
+
+The client (un)subscribes with json text frames:
+
+::
+
+    {"subscribe":   {"streams": ["mummocamera1", ..], "messages": ["mummocamera1", ..]}}
+    {"unsubscribe": {"streams": [..], "messages": [..]}}
+
+Streams can be thinned to keyframes only (see /ws/stream/camname?mode=key&fps=1):
+
+::
+
+    {"subscribe": {"streams": ["mummocamera1"]}, "options": {"mummocamera1": {"mode": "key", "fps": 1}}}
+
+A message channel can be resumed after the last sequence number the client got (see codec.py):
+
+::
+
+    {"subscribe": {"messages": ["mummocamera1"]}, "resume": {"mummocamera1": 1234}}
+
+and the server responds with a json text frame that maps channel numbers to streams & messages:
+
+::
+
+    {
+        "subscribed": [{"channel": 0, "type": "stream", "name": "mummocamera1"}, ..],
+        "unsubscribed": [{"channel": 1, "type": "message", "name": "mummocamera1"}, ..],
+        "missing": [{"type": "stream", "name": "mummocamera2"}, ..],
+        "rejected": [{"type": "stream", "name": "mummocamera3"}, ..]
+    }
+
+A stream is "rejected" when it's over the bandwidth caps (see bandwidth.py)
+
+A channel is also reported in "unsubscribed" when its camera / uuid is removed at the server.
+
+Payload is sent in binary frames, each one prefixed with a 3-byte header:
+
+::
+
+    uint8   type     0 = fmp4 (ftyp, moov, moof, mdat as in /ws/stream/)
+                     1 = message (json utf-8 or binary, as per negotiated subprotocol: see codec.py)
+                     2 = attachment of the previous message in the same channel
+    uint16  channel  channel number (big-endian)
+
+Channels are served round-robin, max. BUDGET fmp4 packets or messages per channel per round
+(message channels first), so a backlogged stream can't starve the other channels.
+
+When there are several MultiServerProcess shards, /ws/mux/{i} is served by shard i.
+Each shard serves the cameras & uuids it owns, others are reported in "missing".
+"""
+import struct
+
+STREAM = 0
+MESSAGE = 1
+ATTACHMENT = 2
+TYPE_NAMES = {STREAM : "stream", MESSAGE : "message"}
+
+HEADER = struct.Struct(">BH")
+MAX_CHANNELS = 65536
+BUDGET = 16 # max. fmp4 packets or messages sent per channel per round
+
+
+def frame(type_, channel, payload):
+    """Returns a binary websocket message (header, payload)
+
+    Pass it as-is to websocket.send: it's sent as a fragmented message, so
+    the payload is not copied
+    """
+    return (HEADER.pack(type_, channel), payload)
+
+
+def asBytes(payload):
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    return payload
@@ -22,6 +22,8 @@ def genConfigFile(**kwargs):
     :param backend_port: 8080
     :param streamer: streamer
     :param ws_port: 3001
+    :param ws_routes: optional argument: dict of websocket (or snapshot) path => port, for example
+        {"/ws/stream/mummocamera1" : 3002}.  Paths not in the dict go to ws_port
     :param no_cache: optional argument: if present and True, 
         nginx tells browser not to cache content
 
@@ -60,9 +62,24 @@ def genConfigFile(**kwargs):
         )
     """
 
+    ws_location = """
+            location = {path} {{
+                proxy_pass http://{streamer}:{port};
+                proxy_http_version 1.1;
+                proxy_set_header Upgrade $http_upgrade;
+                proxy_set_header Connection "upgrade";
+            }}
+    """
+    ws_locations = ""
+    for path, port in kwargs.pop("ws_routes", {}).items():
+        ws_locations += ws_location.format(
+            path=path, streamer=kwargs["streamer"], port=port
+        )
+
     if "no_cache" in kwargs: kwargs.pop("no_cache")
     kwargs["cache_control_part"] = cache_control_part
     kwargs["locations"] = locations
+    kwargs["ws_locations"] = ws_locations
 
     return """user {user};
     worker_processes  1;
@@ -101,13 +118,21 @@ def genConfigFile(**kwargs):
                 proxy_set_header Upgrade $http_upgrade;
                 proxy_set_header Connection "upgrade";
             }}
+            location /snapshot {{
+                proxy_pass http://{streamer}:{ws_port};
+            }}
+            {ws_locations}
         }}
     }}
     """.format(**kwargs)
 
 class NGWrapper:
-
-    def __init__(self, cfg):
+    """
+    :param cfg: the nginx section of the yaml file
+    :param ws_routes: dict of websocket path => port for paths that are not served
+        at the default ws_port (see genConfigFile)
+    """
+    def __init__(self, cfg, ws_routes = {}):
         user = os.environ['USER']
         self.tmpdir=f"/tmp/my_nginx_tmp_{user}"
         self.config_file=f"/tmp/my_nginx_tmp_{user}/nginx.conf"
@@ -122,6 +147,7 @@ class NGWrapper:
             backend_port=8081,
             streamer="localhost",
             ws_port=cfg["ws_port"],
+            ws_routes=ws_routes,
             no_cache=True
         )
 
@@ -0,0 +1,95 @@
+from websockets.legacy.server import WebSocketServerProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+
+"""Default compression policy per websocket endpoint, i.e. per /ws/{endpoint}/..
+
+None = no compression.  H.264 in fmp4 is already compressed, so deflating it is
+just a waste of CPU.
+"""
+DEFAULT_COMPRESSION = {
+    "stream" : None,
+    "jpeg" : None, # already compressed
+    "message" : {
+        "server_max_window_bits" : 12,
+        "client_max_window_bits" : 12,
+        "mem_level" : 5
+    }
+}
+
+
+def deflateFactory(pars):
+    """Creates a permessage-deflate extension factory from yaml parameters
+
+    ::
+
+        server_max_window_bits: 11  # 8..15
+        client_max_window_bits: 11  # 8..15
+        compress_level: 6           # zlib compression level 1..9
+        mem_level: 5                # zlib memory level 1..9
+
+    :param pars: dict or None.  None = no compression
+    """
+    if pars is None:
+        return None
+    compress_settings = {}
+    if "compress_level" in pars:
+        compress_settings["level"] = pars["compress_level"]
+    if "mem_level" in pars:
+        compress_settings["memLevel"] = pars["mem_level"]
+    return ServerPerMessageDeflateFactory(
+        server_max_window_bits = pars.get("server_max_window_bits"),
+        client_max_window_bits = pars.get("client_max_window_bits"),
+        compress_settings = compress_settings
+    )
+
+
+def extensionsByEndpoint(compression_by_endpoint = {}):
+    """Returns endpoint name => list of extension factories
+
+    :param compression_by_endpoint: endpoint name => deflate parameters (see deflateFactory).
+        Endpoints not in the dict use DEFAULT_COMPRESSION
+    """
+    compression = dict(DEFAULT_COMPRESSION)
+    compression.update(compression_by_endpoint)
+    extensions_by_endpoint = {}
+    for endpoint, pars in compression.items():
+        factory = deflateFactory(pars)
+        extensions_by_endpoint[endpoint] = [] if factory is None else [factory]
+    return extensions_by_endpoint
+
+
+class StreamerServerProtocol(WebSocketServerProtocol):
+    """Websocket server protocol that negotiates compression separately for each endpoint
+
+    Use with websockets.serve like this:
+
+    ::
+
+        websockets.serve(handler, host, port,
+            create_protocol = functools.partial(StreamerServerProtocol,
+                extensions_by_endpoint = extensionsByEndpoint({"message": {..}})),
+            compression = None
+        )
+
+    :param extensions_by_endpoint: see extensionsByEndpoint
+    """
+    def __init__(self, *args, extensions_by_endpoint = {}, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.extensions_by_endpoint = extensions_by_endpoint
+
+
+    def getEndpoint(self):
+        """/ws/stream/camname --> stream
+        """
+        parts = self.path.split("?")[0].split("/")
+        if len(parts) < 3:
+            return None
+        return parts[2]
+
+
+    def process_extensions(self, headers, available_extensions):
+        # self.path has been set at this stage of the handshake
+        available_extensions = self.extensions_by_endpoint.get(
+            self.getEndpoint(), available_extensions)
+        return super().process_extensions(headers, available_extensions)
@@ -0,0 +1,45 @@
+"""Placement of cameras into a fixed number of threads (or cpu cores), balanced by stream bitrate
+"""
+
+
+class Placement:
+    """Greedy load balancing: each new key goes into the least loaded bin
+
+    Placing the heaviest keys first gives a good balance (see sortByWeight)
+
+    ::
+
+        placement = Placement(3)
+        placement.place("mummocamera1", 8) # --> bin index 0..2
+        placement.remove("mummocamera1")
+
+    :param n_bins: number of bins
+    """
+    def __init__(self, n_bins = 1):
+        assert(n_bins > 0)
+        self.n_bins = n_bins
+        self.loads = [0] * n_bins
+        self.bin_and_weight_by_key = {}
+
+    def place(self, key, weight = 1):
+        """Returns the bin index for key
+        """
+        if key in self.bin_and_weight_by_key:
+            return self.bin_and_weight_by_key[key][0]
+        i = min(range(self.n_bins), key = lambda i: self.loads[i])
+        self.loads[i] += weight
+        self.bin_and_weight_by_key[key] = (i, weight)
+        return i
+
+    def remove(self, key):
+        try:
+            i, weight = self.bin_and_weight_by_key.pop(key)
+        except KeyError:
+            return
+        self.loads[i] -= weight
+
+
+def sortByWeight(items, weight):
+    """Returns items sorted by weight(item), heaviest first
+    """
+    return sorted(items, key = weight, reverse = True)
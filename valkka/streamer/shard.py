@@ -0,0 +1,45 @@
+"""Consistent hashing of camera names and uuids into MultiServerProcess shards
+
+The same key always maps into the same shard, no matter in which process or
+python session the hash is calculated (unlike python's built-in hash for strings).
+"""
+import hashlib
+from bisect import bisect
+
+
+class HashRing:
+    """A consistent hash ring
+
+    Each shard is placed into the ring at n_replicas pseudo-random points, so that
+    keys are evenly spread & adding a shard moves only ~1/n_shards of the keys.
+
+    ::
+
+        ring = HashRing(4)
+        ring("mummocamera1") # --> shard index 0..3
+
+    :param n_shards: number of shards
+    :param n_replicas: number of points per shard in the ring
+    """
+    def __init__(self, n_shards = 1, n_replicas = 128):
+        assert(n_shards > 0)
+        self.n_shards = n_shards
+        points = []
+        for shard in range(n_shards):
+            for replica in range(n_replicas):
+                points.append((self.hash(f"{shard}-{replica}"), shard))
+        points.sort()
+        self.points = [point for point, shard in points]
+        self.shards = [shard for point, shard in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[0:8], byteorder = "big")
+
+    def __call__(self, key):
+        """Returns the shard index for key
+        """
+        if self.n_shards == 1:
+            return 0
+        i = bisect(self.points, self.hash(key)) % len(self.points)
+        return self.shards[i]